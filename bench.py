@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#
+# Benchmarks for the generation and send pipeline: seeded, repeatable scenarios, with results as JSON for tracking
+# regressions. Sending is to the local sink, in the same process, on a loopback port.
+
+import sys, time, asyncio, argparse, random, json, io, platform, statistics, datetime, contextlib
+
+from emailcontent import *
+from smtpsender import *
+from smtpsink import SMTPSink
+from email.policy import SMTP as SMTP_POLICY
+
+LOREM = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit. Egestas risus, nunc, ultrices est. Tortor, turpis pellentesque '
+    'cursus ornare justo, nibh in venenatis. Faucibus mattis vulputate tristique nisl, malesuada. Molestie lectus sed iaculis sapien at ipsum.')
+
+
+# Content whose html body is about size bytes, with the same placeholders as the usual content files
+def sized_content(sender_subjects: str, size: int):
+    paragraphs = max(1, size // (len(LOREM) + 8))
+    html = '<html><body><p>{{top}}</p><h1>{{name}}</h1>\n' + f'<p>{LOREM}</p>\n' * paragraphs + \
+        '<p>This email was sent to {{recipient_name}} at {{recipient}}. <a href="{{unsubscribe_url}}">Unsubscribe</a></p>\n' + \
+        '<img alt="" height="1" src="{{tracking_url}}" width="1"/>\n</body></html>\n'
+    text = '{{top}}\n\n{{name}}\n\n' + f'{LOREM}\n\n' * paragraphs + 'This email was sent to {{recipient_name}} at {{recipient}}.\nUnsubscribe: {{unsubscribe_url}}\n'
+    return EmailContent(io.StringIO(sender_subjects), io.StringIO(html), io.StringIO(text))
+
+
+def result(scenario, n, seconds, **extra):
+    return dict(scenario=scenario, messages=n, seconds=round(seconds, 6), rate=round(n / seconds, 1) if seconds > 0 else None, **extra)
+
+
+# Building pre-serialized messages, as sent normally
+def bench_generate(n, names, content, bounces, size):
+    t = time.perf_counter()
+    total = sum(len(m.data) for m in rand_messages(n, names, content, bounces, raw=True))
+    return result('generate', n, time.perf_counter() - t, size=size, mean_bytes=total // n)
+
+
+# Building EmailMessage objects, then serializing them as aiosmtplib would before sending
+def bench_serialize(n, names, content, bounces, size):
+    msgs = list(rand_messages(n, names, content, bounces, raw=False))
+    t = time.perf_counter()
+    total = sum(len(m.as_bytes(policy=SMTP_POLICY)) for m in msgs)
+    return result('serialize', n, time.perf_counter() - t, size=size, mean_bytes=total // n)
+
+
+# Generating and sending, over connections to the sink. Retries are off, as their backoff would swamp the timings.
+async def bench_send(n, names, content, bounces, size, connections, pipelining, chunking, show_errors = False):
+    sink = SMTPSink(seed=1)
+    server = await sink.start('127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        with contextlib.nullcontext() if show_errors else contextlib.redirect_stderr(io.StringIO()):
+            stats = await send_batch(rand_messages(n, names, content, bounces), max_connections=connections, servers=[Target('127.0.0.1', port)],
+                pipelining=pipelining, chunking=chunking, retries=0)
+    finally:
+        server.close()
+    return result('send', stats.attempted, stats.elapsed, size=size, connections=connections, pipelining=pipelining, chunking=chunking,
+        delivered=stats.delivered, failed=stats.failed, lost=stats.lost,
+        latency_mean_ms=round(statistics.fmean(stats.latency) * 1000, 3) if stats.latency else None,
+        latency_p95_ms=round(percentile(stats.latency, 95) * 1000, 3) if stats.latency else None,
+        generate_seconds=round(stats.generate_time, 6))
+
+
+def describe(r):
+    s = f"{r['scenario']:<10} size {r['size']:>7}"
+    if r['scenario'] == 'send':
+        s += f", {r['connections']:>3} connections"
+    s += f": {r['messages']} messages in {r['seconds']:.3f}s, {r['rate']} msg/s"
+    if r['scenario'] == 'send':
+        s += f", latency mean {r['latency_mean_ms']}ms p95 {r['latency_p95_ms']}ms, {r['delivered']} delivered {r['failed']} failed {r['lost']} lost"
+    return s
+
+
+# -----------------------------------------------------------------------------
+# Main code
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark message generation, serialization and sending to an in-process sink')
+    parser.add_argument('--bounces', type=argparse.FileType('r'), default='demo_bounces.csv', help='bounce configuration file (csv)')
+    parser.add_argument('--sender-subjects', type=argparse.FileType('r'), default='sender_subjects.csv', help='senders and subjects configuration file (csv)')
+    parser.add_argument('--scenarios', choices=['generate', 'serialize', 'send'], nargs='+', default=['generate', 'serialize', 'send'], help='what to measure')
+    parser.add_argument('--messages', type=int, default=1000, help='messages per scenario')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2000, 20000, 200000], help='approximate html body sizes, in bytes')
+    parser.add_argument('--connections', type=int, nargs='+', default=[1, 4, 16], help='connection counts for the send scenario')
+    parser.add_argument('--pipelining', action='store_true', help='send scenario: use PIPELINING')
+    parser.add_argument('--chunking', action='store_true', help='send scenario: use BDAT')
+    parser.add_argument('--show-errors', action='store_true', help='send scenario: print the bounces and errors, as normal runs do')
+    parser.add_argument('--seed', type=str, default='1', help='random seed, so runs generate the same messages')
+    parser.add_argument('--output', type=str, help='write the results to this file as JSON (default: stdout)')
+    args = parser.parse_args()
+
+    bounces = BounceCollection(args.bounces)
+    sender_subjects = args.sender_subjects.read()
+    results = []
+    for size in args.sizes:
+        content = sized_content(sender_subjects, size)
+        runs = [(s, None) for s in args.scenarios if s != 'send']
+        if 'send' in args.scenarios:
+            runs += [('send', c) for c in args.connections]
+        for scenario, connections in runs:
+            random.seed(f'{args.seed}-{scenario}-{size}-{connections}') # each scenario is repeatable on its own
+            names = NamesCollection(100)
+            if scenario == 'generate':
+                r = bench_generate(args.messages, names, content, bounces, size)
+            elif scenario == 'serialize':
+                r = bench_serialize(args.messages, names, content, bounces, size)
+            else:
+                r = asyncio.run(bench_send(args.messages, names, content, bounces, size, connections, args.pipelining, args.chunking,
+                    args.show_errors))
+            eprint(describe(r))
+            results.append(r)
+
+    report = {
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -1,22 +1,32 @@
 #!/usr/bin/env python3
 
-import random, names, csv, datetime, string, io
+import random, csv, datetime, string, io, time, bisect, re
+from email import quoprimime
 from email.headerregistry import Address
 from email.message import EmailMessage
+from email.policy import SMTP
+from email.utils import make_msgid, formatdate
+from sampling import AliasSampler, ZipfSampler, Permutation, mix64
+from nametable import NameTable, name_table
+from template import Template
 
 # -----------------------------------------------------------------------------------------
 # First and last names from 1990 US Census data
 # -----------------------------------------------------------------------------------------
 class NamesCollection:
-    def __init__(self, size):
-        # Prepare a local list of actual random names
-        self.names = []
+    def __init__(self, size, table: NameTable = None):
+        # Prepare a local list of actual random names, chosen by how common they are, each with its lower-case form for the address
+        table = table or name_table()
+        self.first = []
+        self.last = []
         for i in range(size):
-            self.names.append({'first': names.get_first_name(), 'last': names.get_last_name()})
+            first, last = table.first[table.first.sample()], table.last[table.last.sample()]
+            self.first.append((first, first.lower()))
+            self.last.append((last, last.lower()))
 
     def rand_name(self):
        # Compose a real readable name from the pre-built two-part list l.  Randomise first and last names separately, giving more variety
-       return random.choice(self.names)['first'], random.choice(self.names)['last']
+       return random.choice(self.first)[0], random.choice(self.last)[0]
 
     def rand_recip(self, domain):
         first, last = self.rand_name()
@@ -25,7 +35,59 @@ class NamesCollection:
             suffix = str(random.randint(1, 999))
         else:
             suffix = ''
-        return Address(first + ' ' + last, str.lower(first) + '.' + str.lower(last) + suffix + '@' + domain)
+        return Address(first + ' ' + last, str.lower(first) + '.' + str.lower(last) + suffix, domain)
+
+    # Batch version of rand_recip, one recipient per domain given
+    def rand_recips(self, domains: list):
+        k = len(domains)
+        firsts = random.choices(self.first, k=k)
+        lasts = random.choices(self.last, k=k)
+        rand = random.random
+        recips = []
+        for (first, first_lower), (last, last_lower), domain in zip(firsts, lasts, domains):
+            # Same odds of a number suffix as rand_recip
+            suffix = str(int(rand() * 999) + 1) if rand() < 799 / 999 else ''
+            recips.append(Address(first + ' ' + last, first_lower + '.' + last_lower + suffix, domain))
+        return recips
+
+# -----------------------------------------------------------------------------------------
+# A large, stable population of recipients on each domain, addressed by index rather than stored. Recipient i of a
+# domain is always the same address, first.last plus a number unique to them, with the names chosen by how common they
+# are. Which recipients are the most popular differs between domains, as ranks are mapped to recipients by a keyed
+# permutation per domain.
+# -----------------------------------------------------------------------------------------
+class RecipientSpace:
+    def __init__(self, size, popularity = 'uniform', exponent = 1.0, key = 'recipients'):
+        self.size = size # distinct recipients per domain
+        self.popularity = popularity # 'uniform', or 'zipf' to send to some recipients far more often than others
+        self.zipf = ZipfSampler(size, exponent) if popularity == 'zipf' else None
+        self.key = key
+        self.permutations = {} # domain -> Permutation, made as needed
+
+    # The recipient at this popularity rank on the domain
+    def recipient(self, domain, rank):
+        p = self.permutations.get(domain)
+        if p is None:
+            p = self.permutations[domain] = Permutation(self.size, f'{self.key}:{domain}')
+        i = p[rank]
+        # The names depend only on i, so the same person can be found on several domains
+        h = mix64(i)
+        table = name_table()
+        first = table.first[bisect.bisect_right(table.first.cumulative, ((h & 0xFFFFFFFF) * table.first.total) >> 32)]
+        last = table.last[bisect.bisect_right(table.last.cumulative, ((h >> 32) * table.last.total) >> 32)]
+        return Address(first + ' ' + last, f'{first.lower()}.{last.lower()}{i + 1}', domain)
+
+    def rand_recip(self, domain):
+        return self.rand_recips([domain])[0]
+
+    # Batch version of rand_recip, one recipient per domain given
+    def rand_recips(self, domains: list):
+        if self.zipf:
+            ranks = self.zipf.sample_n(len(domains))
+        else:
+            ranks = [int(random.random() * self.size) for _ in domains]
+        return [self.recipient(domain, rank) for domain, rank in zip(domains, ranks)]
+
 
 # -----------------------------------------------------------------------------------------
 # Realistic bounce codes
@@ -54,16 +116,18 @@ class BounceCollection:
                 if t:
                     self.weights.append(weight/n)
                     break
+        # Precompute domain class membership, and an alias table for O(1) weighted domain draws
+        self.yahoo_flags = [self.is_yahoo(d)[0] for d in self.domains]
+        self.domain_sampler = AliasSampler(self.weights)
 
-    # Record DSN diags as a grouped, nested structure in the form [ domain ( ..) ]
+    # Record DSN diags as a grouped, nested structure in the form [ domain ( ..) ], with each text parsed for its placeholders
     def add(self, domain, code, enhanced, text):
         if not domain in self.domain_codes:
             self.domain_codes[domain] = []
-        self.domain_codes[domain].append( (code, enhanced, text) )
+        self.domain_codes[domain].append( (code, enhanced, Template(text, BOUNCE_PLACEHOLDERS)) )
 
     def rand_domain(self):
-        dlist = random.choices(self.domains, self.weights)
-        return dlist[0]
+        return self.domains[self.domain_sampler.sample()]
 
     def all_domains(self):
         return self.domains
@@ -71,18 +135,9 @@ class BounceCollection:
     # Return a random bounce (code, enhanced, text) for a given domain and recipient
     def rand_bounce(self, domain, recip_addr:str):
         codes = self.domain_codes[domain] # note this returns a list, so have to dereference it
-        code, enhanced, text = random.choice(codes) # pick from the codes with an even distribution
-        # Fill in placeholders
-        placeholders = [
-            ('{{to}}', self.bounce_to),
-            ('{{verp}}', self.bounce_verp),
-            ('{{ip4addr}}', self.bounce_ip4addr),
-            ('{{datetime}}', self.bounce_datetime),
-            ('{{datetime_uuid}}', self.bounce_datetime_uuid),
-            ('{{google_uuid}}', self.bounce_google_uuid),
-        ]
-        for holder, func in placeholders:
-            text = text.replace(holder, func(recip_addr))
+        code, enhanced, template = random.choice(codes) # pick from the codes with an even distribution
+        # Fill in placeholders, making values only for those this text has
+        text = template.render({name: BOUNCE_PLACEHOLDERS[name](self, recip_addr) for name in template.names})
         return code, enhanced, text
 
     def bounce_to(self, t):
@@ -116,23 +171,37 @@ class BounceCollection:
         return s
 
     def is_google(self, d):
-        domains = ['gmail.com']
-        return (d in domains), len(domains)
+        return (d in GOOGLE_DOMAINS), len(GOOGLE_DOMAINS)
 
     def is_microsoft(self, d):
-        domains = ['hotmail.com', 'msn.com', 'hotmail.co.jp', 'live.com', 'outlook.com', 'hotmail.co.uk', 'hotmail.fr', 'live.jp', 'hotmail.de',
-            'live.co.uk', 'hotmail.es', 'live.fr', 'live.in']
-        return (d in domains), len(domains)
+        return (d in MICROSOFT_DOMAINS), len(MICROSOFT_DOMAINS)
 
     def is_yahoo(self, d):
-        domains = ['yahoo.ca', 'yahoo.co.in', 'yahoo.co.jp', 'yahoo.co.uk', 'yahoo.com', 'yahoo.com.br', 'yahoo.de', 'yahoo.es', 'yahoo.gr', 
-            'yahoo.ie', 'yahoo.in', 'yahoo.it']
-        return (d in domains), len(domains)
+        return (d in YAHOO_DOMAINS), len(YAHOO_DOMAINS)
 
     def is_others(self, d):
         return True, len(self.domain_codes) # Note this is slightly on the low side 
 
 
+# Placeholders in bounce texts, and the functions making their values from the recipient address
+BOUNCE_PLACEHOLDERS = {
+    'to': BounceCollection.bounce_to,
+    'verp': BounceCollection.bounce_verp,
+    'ip4addr': BounceCollection.bounce_ip4addr,
+    'datetime': BounceCollection.bounce_datetime,
+    'datetime_uuid': BounceCollection.bounce_datetime_uuid,
+    'google_uuid': BounceCollection.bounce_google_uuid,
+}
+
+GOOGLE_DOMAINS = frozenset(['gmail.com'])
+
+MICROSOFT_DOMAINS = frozenset(['hotmail.com', 'msn.com', 'hotmail.co.jp', 'live.com', 'outlook.com', 'hotmail.co.uk', 'hotmail.fr', 'live.jp',
+    'hotmail.de', 'live.co.uk', 'hotmail.es', 'live.fr', 'live.in'])
+
+YAHOO_DOMAINS = frozenset(['yahoo.ca', 'yahoo.co.in', 'yahoo.co.jp', 'yahoo.co.uk', 'yahoo.com', 'yahoo.com.br', 'yahoo.de', 'yahoo.es', 'yahoo.gr',
+    'yahoo.ie', 'yahoo.in', 'yahoo.it'])
+
+
 def rand_ascii_letter():
     return random.choice(string.ascii_lowercase)
 
@@ -153,37 +222,220 @@ class EmailContent:
             if row_dict['x_job'] != 'x_job': # skip the header row
                 self.add(row_dict)
 
-        self.htmlTemplate = html_file.read()
-        self.textTemplate = txt_file.read()
+        self.htmlTemplate = Template(html_file.read(), CONTENT_PLACEHOLDERS)
+        self.textTemplate = Template(txt_file.read(), CONTENT_PLACEHOLDERS)
+        # There are only as many distinct bodies as content rows, so fill in each one's placeholders and build it just once.
+        # Any per-recipient placeholders are left for each message.
+        self.bodies = [self.text_html(s) for s in self.content]
+        self.mime_cache = [MimeTemplate(s, *body) for s, body in zip(self.content, self.bodies)]
 
     def add(self, sender_subject):
         self.content.append(sender_subject)
 
-    # generate a bunch of random related things for the email
-    def rand_job_subj_text_html_from(self):
-        s = random.choice(self.content)
-        from_address = Address(s['from_name'], s['from_addr'])
+    def text_html(self, s):
         # Contents include a valid link
-        text = self.textTemplate.replace('{{top}}', s['x_job']).replace('{{name}}', s['from_name'])
-        html = self.htmlTemplate.replace('{{top}}', s['x_job']).replace('{{name}}', s['from_name'])
-        return s['x_job'], s['subject'], text, html, from_address, float(s['bounce_rate']), s['retry_percent']
-
+        values = {'top': s['x_job'], 'name': s['from_name']}
+        return self.textTemplate.fill(values), self.htmlTemplate.fill(values)
 
-# Generator yielding a list of n randomized messages
-def rand_messages(n: int, names: NamesCollection, content: EmailContent, bounces: BounceCollection):
-    for i in range(n):
-        yield rand_message(names, content, bounces)
+    # generate a bunch of random related things for the email. The text and html are Templates, still to be filled in for the recipient.
+    def rand_job_subj_text_html_from(self):
+        i = random.randrange(len(self.content))
+        s = self.content[i]
+        from_address = Address(s['from_name'], addr_spec=s['from_addr'])
+        text, html = self.bodies[i]
+        return s['x_job'], s['subject'], text, html, from_address, float(s['bounce_rate']), s['retry_percent']
 
 
-def rand_message(names: NamesCollection, content: EmailContent, bounces: BounceCollection):
+# -----------------------------------------------------------------------------------------
+# A content row pre-serialized to bytes: per-message headers are spliced on at send time
+# -----------------------------------------------------------------------------------------
+class MimeTemplate:
+    def __init__(self, s, text: Template, html: Template):
+        self.x_job = s['x_job']
+        self.from_addr = s['from_addr']
+        self.from_domain = s['from_addr'].split('@')[-1]
+        self.bounce_rate = float(s['bounce_rate'])
+        self.retry_percent = s['retry_percent']
+        # Headers go in the same order as rand_message, with the recipient's To: between these two
+        self.head = fold_header('Subject', s['subject']) + fold_header('From', str(Address(s['from_name'], addr_spec=s['from_addr'])))
+        self.tail = fold_header('X-Job', s['x_job'])
+        self.names = tuple(dict.fromkeys(text.names + html.names)) # per-recipient placeholders
+        msg = EmailMessage()
+        if self.names:
+            # Encode the parts here, one literal piece at a time, leaving the placeholders to fill with encoded values
+            msg.set_content('BODYPART0', charset='utf-8', cte='quoted-printable')
+            msg.add_alternative('BODYPART1', subtype='html', charset='utf-8', cte='quoted-printable')
+            body = msg.as_bytes(policy=SMTP).replace(b'BODYPART0', qp_template(text), 1).replace(b'BODYPART1', qp_template(html), 1)
+        else:
+            msg.set_content(text.render({}))
+            msg.add_alternative(html.render({}), subtype='html')
+            body = msg.as_bytes(policy=SMTP)
+        self.body = Template(body, self.names) # MIME-Version and Content-Type headers, then the encoded parts
+
+    # Any other_recips (on the same domain) go in the envelope only, as in a bulk send
+    def message(self, recip_addr: Address, extra_headers: list, other_recips: list = ()):
+        msgid = make_msgid(domain=self.from_domain)
+        headers = [self.head, fold_header('To', str(recip_addr)), self.tail]
+        for hdr, value in extra_headers:
+            headers.append(fold_header(hdr, value))
+        headers.append(f'Message-ID: {msgid}\r\nDate: {rfc2822_now()}\r\n'.encode())
+        if self.names:
+            values = recipient_values(self.names, recip_addr, msgid, self.from_domain)
+            headers.append(self.body.render({name: qp_value(v) for name, v in values.items()}))
+        else:
+            headers.append(self.body.parts[0])
+        return RawMessage(self.from_addr, [recip_addr.addr_spec] + [a.addr_spec for a in other_recips], b''.join(headers))
+
+
+# Placeholders in the content files: those for the sender, filled in once, and those for each recipient
+CONTENT_PLACEHOLDERS = ('top', 'name', 'recipient', 'recipient_name', 'message_id', 'unsubscribe_url', 'tracking_url')
+
+# The values of the per-recipient placeholders in names. Links are unique to the message, using its Message-ID.
+def recipient_values(names, recip_addr: Address, msgid: str, domain: str):
+    msgid = msgid.strip('<>')
+    token = msgid.split('@')[0]
+    values = {
+        'recipient': lambda: recip_addr.addr_spec,
+        'recipient_name': lambda: recip_addr.display_name,
+        'message_id': lambda: msgid,
+        'unsubscribe_url': lambda: f'https://{domain}/unsubscribe/{token}',
+        'tracking_url': lambda: f'https://{domain}/open/{token}.gif',
+    }
+    return {name: values[name]() for name in names}
+
+
+# Quoted-printable encode a Template's literal pieces, once, with each placeholder on a line of its own between
+# soft line breaks. The value then can't be split by the line wrapping, and decodes in place.
+def qp_template(t: Template):
+    literals, names = t.literals()
+    literals[-1] = literals[-1].removesuffix('\n') # the part's final line break is already there
+    body = qp_encode(literals[0])
+    for name, literal in zip(names, literals[1:]):
+        body += b'=\r\n{{' + name.encode('ascii') + b'}}=\r\n' + qp_encode(literal)
+    return body
+
+
+def qp_encode(s: str, maxlinelen = 76):
+    return quoprimime.body_encode(s.encode('utf-8').decode('latin-1'), maxlinelen, eol='\r\n').encode('ascii')
+
+
+# A placeholder value, quoted-printable encoded to go on its own line (so just as it is, in the usual case)
+def qp_value(v: str):
+    if v.isascii() and len(v) < 76 and '=' not in v and '\n' not in v and '\r' not in v and not v.endswith((' ', '\t')):
+        return v.encode('ascii')
+    return qp_encode(v, 75)
+
+
+# A message already serialized to bytes, with its envelope, for sending with SMTP.sendmail
+class RawMessage:
+    __slots__ = ('mail_from', 'rcpt_to', 'data')
+
+    def __init__(self, mail_from: str, rcpt_to: list, data: bytes):
+        self.mail_from = mail_from
+        self.rcpt_to = rcpt_to
+        self.data = data
+
+    def add_header(self, hdr, value):
+        self.data = fold_header(hdr, value) + self.data
+
+
+# Encode a header line, folding long values and RFC 2047-encoding any non-ASCII. Plain ASCII values, such as the bounce
+# headers on every bounced message, are folded here at whitespace, which is much quicker than the email package.
+def fold_header(hdr, value):
+    if value.isascii() and '\r' not in value and '\n' not in value and '=?' not in value:
+        line = f'{hdr}: {value}'
+        if len(line) <= 78:
+            return (line + '\r\n').encode('ascii')
+        return fold_words(line).encode('ascii')
+    return SMTP.header_factory(hdr, value).fold(policy=SMTP).encode('ascii')
+
+
+FOLDABLE = re.compile(r'[ \t]*[^ \t]+|[ \t]+$')
+
+# Fold a header line before whitespace, so lines are at most 78 characters unless a single word is longer
+def fold_words(line):
+    lines = []
+    current = ''
+    for word in FOLDABLE.findall(line):
+        if current and len(current) + len(word) > 78 and word[0] in ' \t':
+            lines.append(current)
+            current = word
+        else:
+            current += word
+    lines.append(current)
+    return '\r\n'.join(lines) + '\r\n'
+
+
+# Date header value, formatted at most once per second
+_date_cache = (0, '')
+def rfc2822_now():
+    global _date_cache
+    now = int(time.time())
+    if _date_cache[0] != now:
+        _date_cache = (now, formatdate(now, localtime=True))
+    return _date_cache[1]
+
+
+# Generator yielding a list of n randomized messages. raw=True gives pre-serialized RawMessage objects, which are much
+# faster to build and send; raw=False builds each one as an EmailMessage. Raw messages can have several recipients,
+# all on the same domain. bounce=False leaves out the bounce headers, so every message is accepted by the sink.
+def rand_messages(n: int, names: NamesCollection, content: EmailContent, bounces: BounceCollection, raw=True, recipients = 1, bounce = True):
+    if raw:
+        yield from rand_raw_messages(n, names, content, bounces, recipients=recipients, bounce=bounce)
+    else:
+        for i in range(n):
+            yield rand_message(names, content, bounces, bounce)
+
+
+# Generator yielding n pre-serialized messages. The random choices are drawn for a chunk of messages at a time,
+# which is much cheaper than separate calls per message, then streamed to the message builder.
+def rand_raw_messages(n: int, names: NamesCollection, content: EmailContent, bounces: BounceCollection, chunk = 1000, recipients = 1,
+        bounce = True):
+    for start in range(0, n, chunk):
+        k = min(chunk, n - start)
+        domain_idx = bounces.domain_sampler.sample_n(k)
+        domains = [bounces.domains[i] for i in domain_idx]
+        if recipients > 1:
+            recips = names.rand_recips([d for d in domains for _ in range(recipients)])
+            others = [recips[j + 1:j + recipients] for j in range(0, len(recips), recipients)]
+            recips = recips[::recipients]
+        else:
+            recips = names.rand_recips(domains)
+            others = [()] * k
+        templates = random.choices(content.mime_cache, k=k)
+        draws = [random.random() for _ in range(k)]
+        # The bounce decision is per message, as the sink replies once to the whole transaction
+        for i, domain, recip_addr, other_recips, t, draw in zip(domain_idx, domains, recips, others, templates, draws):
+            # special configurable bounce rates for Yahoo domains
+            bounce_rate = bounces.yahoo_backoff if bounces.yahoo_backoff and bounces.yahoo_flags[i] else t.bounce_rate
+            if bounce and draw <= bounce_rate:
+                yield t.message(recip_addr, bounce_headers(bounces, domain, recip_addr, t.retry_percent), other_recips)
+            else:
+                yield t.message(recip_addr, [], other_recips)
+
+
+def rand_message(names: NamesCollection, content: EmailContent, bounces: BounceCollection, bounce = True):
         recip_domain = bounces.rand_domain()
         recip_addr = names.rand_recip(recip_domain)
         msg = EmailMessage()
         x_job, subject, body_text, body_html, from_addr, bounce_rate, retry_percent = content.rand_job_subj_text_html_from()
+        msgid = make_msgid(domain=from_addr.domain)
         msg['Subject'] = subject
         msg['From'] = from_addr
         msg['To'] = recip_addr
         msg['X-Job'] = x_job
+        if bounce:
+            for hdr, value in rand_bounce_headers(bounces, recip_domain, recip_addr, bounce_rate, retry_percent):
+                msg[hdr] = value
+        msg['Message-ID'] = msgid
+        values = recipient_values(body_text.names + body_html.names, recip_addr, msgid, from_addr.domain)
+        msg.set_content(body_text.render(values))
+        msg.add_alternative(body_html.render(values), subtype='html')
+        return msg
+
+
+# Headers (if any) that mark the message to bounce from the sink
+def rand_bounce_headers(bounces: BounceCollection, recip_domain, recip_addr: Address, bounce_rate, retry_percent):
         # special configurable bounce rates for Yahoo domains
         if bounces.yahoo_backoff:
             t, _ = bounces.is_yahoo(recip_domain)
@@ -191,12 +443,16 @@ def rand_message(names: NamesCollection, content: EmailContent, bounces: BounceC
                 bounce_rate = bounces.yahoo_backoff
         # check and mark the message to bounce in the header
         if random.random() <= bounce_rate:
-            code, enhanced, bounce_text = bounces.rand_bounce(recip_domain, recip_addr.username)
-            msg['X-Bounce-Me'] = f'{code} {enhanced} {bounce_text}'
-            msg['X-Bounce-Percentage'] = str(retry_percent) # Pass in a <100 bounce percentage, so that deferred messages will eventually clear
-        msg.set_content(body_text)
-        msg.add_alternative(body_html, subtype='html')
-        return msg
+            return bounce_headers(bounces, recip_domain, recip_addr, retry_percent)
+        return []
+
+
+def bounce_headers(bounces: BounceCollection, recip_domain, recip_addr: Address, retry_percent):
+        code, enhanced, bounce_text = bounces.rand_bounce(recip_domain, recip_addr.addr_spec)
+        return [
+            ('X-Bounce-Me', f'{code} {enhanced} {bounce_text}'),
+            ('X-Bounce-Percentage', str(retry_percent)), # Pass in a <100 bounce percentage, so that deferred messages will eventually clear
+        ]
 
 # -----------------------------------------------------------------------------
 # Main code - for testing
@@ -210,6 +466,41 @@ if __name__ == "__main__":
                     content = EmailContent(sender_subjects_file, html_file, txt_file)
                     nNames = 50
                     names = NamesCollection(nNames) # Get some pseudorandom recipients
-                    msgs = rand_messages(100, names, content, bounces)
+                    msgs = rand_messages(100, names, content, bounces, raw=False)
                     for m in msgs:
                         print(m['from'],m['to'],m['subject'])
+
+                    # Compare building (and serializing, as aiosmtplib does before sending) each message, with the cached fast path
+                    n = 10000
+                    t = time.perf_counter()
+                    for m in rand_messages(n, names, content, bounces, raw=False):
+                        m.as_bytes(policy=SMTP)
+                    t_msg = time.perf_counter() - t
+                    t = time.perf_counter()
+                    for m in rand_messages(n, names, content, bounces, raw=True):
+                        pass
+                    t_raw = time.perf_counter() - t
+                    print(f'EmailMessage: {n / t_msg:.0f} messages/s, pre-serialized MIME template: {n / t_raw:.0f} messages/s')
+
+                    # Random draws only (domain, name, suffix, content, bounce decision), per message vs. in batches
+                    n = 100000
+                    t = time.perf_counter()
+                    for i in range(n):
+                        d = bounces.rand_domain()
+                        names.rand_recip(d)
+                        random.choice(content.mime_cache)
+                        bounces.is_yahoo(d)
+                        random.random()
+                    t_single = time.perf_counter() - t
+                    t = time.perf_counter()
+                    for start in range(0, n, 1000):
+                        domains = [bounces.domains[i] for i in bounces.domain_sampler.sample_n(1000)]
+                        names.rand_recips(domains)
+                        random.choices(content.mime_cache, k=1000)
+                        [random.random() for _ in range(1000)]
+                    t_batch = time.perf_counter() - t
+                    print(f'Random draws for {n} messages: {t_single / n * 1e6:.2f}us per message singly, {t_batch / n * 1e6:.2f}us in batches')
+                    t = time.perf_counter()
+                    for m in rand_raw_messages(n, names, content, bounces):
+                        pass
+                    print(f'{n} pre-serialized messages, drawn in batches: {(time.perf_counter() - t) / n * 1e6:.2f}us per message')
@@ -2,26 +2,88 @@
 #
 # Create fake MX and A records for recipient domains to enable loopback to a sink via a local "unbound" DNS resolver
 
-import argparse, dns.resolver
+import argparse, asyncio, json, os, sys, time, dns.asyncresolver, dns.exception, dns.nameserver, dns.resolver
 from typing import Iterable
 from emailcontent import *
 
+#Print to stderr - see https://stackoverflow.com/a/14981125/8545455
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
 class myDNS:
-    def __init__(self, domains:Iterable):
+    def __init__(self, domains:Iterable, cache_file:str = None, nameservers:list = None, concurrency:int = 50, timeout:float = 5.0, min_ttl:int = 0):
         self.domains = domains
         self.mx_records = []
         self.exchanges = []
+        self.exchange_set = set()
         self.width = 60 # column width for domain names
-        # Merge a list of real MX records, collecting the exchanges as we go
+        self.cache_file = cache_file
+        self.cache = self.load_cache() # domain -> {'expires': time, 'mx': [[preference, exchange], ...]}
+        self.min_ttl = min_ttl # keep results at least this long, whatever their TTL
+        self.failed = []
+        self.queried = 0
+        # Query only the domains that are new or have expired, concurrently
+        now = time.time()
+        todo = [d for d in domains if d not in self.cache or self.cache[d]['expires'] <= now]
+        if todo:
+            asyncio.run(self.resolve_all(todo, self.make_resolver(nameservers, timeout), concurrency))
+        self.save_cache()
+        # Merge a list of real MX records, collecting the exchanges as we go. Domains that failed are left out.
         for domain in domains:
-            result = dns.resolver.resolve(domain, 'MX')
-            self.mx_records += list(self.mx_record_gen(domain, result))
+            if domain in self.cache:
+                self.mx_records += list(self.mx_record_gen(domain, self.cache[domain]['mx']))
+
+    def make_resolver(self, nameservers:list, timeout:float):
+        if nameservers:
+            resolver = dns.asyncresolver.Resolver(configure=False)
+            servers = []
+            for ns in nameservers:
+                host, _, port = ns.rpartition(':') if ns.count(':') == 1 else (ns, '', '') # IPv6 addresses are given without a port
+                servers.append(dns.nameserver.Do53Nameserver(host, int(port) if port else 53)) # each with its own port
+            resolver.nameservers = servers
+        else:
+            resolver = dns.asyncresolver.Resolver() # from /etc/resolv.conf
+        resolver.lifetime = timeout
+        return resolver
+
+    async def resolve_all(self, domains:list, resolver, concurrency:int):
+        limit = asyncio.Semaphore(concurrency)
+        await asyncio.gather(*[self.resolve(domain, resolver, limit) for domain in domains])
+
+    # Resolve one domain's MX records into the cache. A domain that fails is reported and skipped, rather than stopping the run.
+    async def resolve(self, domain:str, resolver, limit:asyncio.Semaphore):
+        async with limit:
+            self.queried += 1
+            try:
+                result = await resolver.resolve(domain, 'MX')
+            except (dns.exception.DNSException, OSError) as e:
+                eprint(f'{domain}: {e.__class__.__name__}: {e}')
+                self.failed.append(domain)
+                return
+            self.cache[domain] = {
+                'expires': time.time() + max(result.rrset.ttl, self.min_ttl),
+                'mx': sorted([answer.preference, answer.exchange.to_text()] for answer in result),
+            }
+
+    def load_cache(self):
+        if self.cache_file and os.path.exists(self.cache_file):
+            with open(self.cache_file) as f:
+                return json.load(f)
+        return {}
+
+    def save_cache(self):
+        if self.cache_file:
+            tmp = f'{self.cache_file}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.cache, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.cache_file)
 
     # Return each MX as a simple tuple
-    def mx_record_gen(self, domain:string, result:tuple):
-        for answer in result:
-            preference, exchange = answer.preference, answer.exchange.to_text()
-            self.exchanges.append(exchange)
+    def mx_record_gen(self, domain:string, result:list):
+        for preference, exchange in result:
+            if exchange not in self.exchange_set:
+                self.exchanges.append(exchange) # many domains share exchanges, which need only one A record each
+                self.exchange_set.add(exchange)
             yield (domain, preference, exchange)
 
     def print(self, prefix:string, suffix:string):
@@ -39,10 +101,18 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description='Create fake MX and A records for recipient domains to enable loopback to a sink via a local "unbound" DNS resolver')
     parser.add_argument('--bounces', type=argparse.FileType('r'), required=True, help='bounce configuration file (csv)')
+    parser.add_argument('--cache', type=str, default='fake-mx-cache.json', help='file to keep MX results in, so only new or expired domains are queried next time ("" for none)')
+    parser.add_argument('--min-ttl', type=int, default=86400, help='keep cached results for at least this many seconds, even if their TTL is shorter')
+    parser.add_argument('--nameserver', type=str, nargs='+', help='DNS server(s) to query, as address or address:port (default: the system resolver)')
+    parser.add_argument('--concurrency', type=int, default=50, help='most DNS queries to have in flight at once')
+    parser.add_argument('--timeout', type=float, default=5.0, help='seconds to wait for each domain\'s answer, including retries')
     args = parser.parse_args()
 
     bounces = BounceCollection(args.bounces)
     # List of all domains, deduped and alphabetically sorted
-    my_records = myDNS(sorted(set(bounces.all_domains())))
+    t = time.perf_counter()
+    my_records = myDNS(sorted(set(bounces.all_domains())), args.cache or None, args.nameserver, args.concurrency, args.timeout, args.min_ttl)
+    eprint(f'{len(my_records.domains)} domains: {len(my_records.domains) - my_records.queried} cached, {my_records.queried} queried '
+           f'({len(my_records.failed)} failed) in {time.perf_counter() - t:.2f}s')
     # Output in a format for "unbound" conf file
-    my_records.print('  local-data: "', '"')
\ No newline at end of file
+    my_records.print('  local-data: "', '"')
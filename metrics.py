@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+#
+# Prometheus metrics for the generator: text exposition format, served over HTTP or written for the textfile collector
+
+import os, asyncio, bisect
+
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# name: (type, help text). Counters are named with their _total suffix.
+METRICS = {
+    'smtp_traffic_gen_messages_attempted_total': ('counter', 'Messages the generator tried to send'),
+    'smtp_traffic_gen_messages_total': ('counter', 'Messages sent, by result (delivered, failed, lost) and final SMTP reply code'),
+    'smtp_traffic_gen_retries_total': ('counter', 'Messages tried again after a temporary failure, by SMTP reply code (none if the connection failed)'),
+    'smtp_traffic_gen_recipients_total': ('counter', 'Recipients accepted or refused at RCPT TO, by SMTP reply code'),
+    'smtp_traffic_gen_connections_total': ('counter', 'SMTP connections opened'),
+    'smtp_traffic_gen_connection_phase_seconds': ('histogram', 'Time taken by each phase of opening a connection (connect, ehlo, starttls, auth)'),
+    'smtp_traffic_gen_tls_handshakes_total': ('counter', 'TLS handshakes, by whether an earlier session was resumed'),
+    'smtp_traffic_gen_tls_handshake_seconds': ('histogram', 'Time taken by each TLS handshake (for STARTTLS, from the command to the handshake done)'),
+    'smtp_traffic_gen_send_seconds': ('histogram', 'Time to send one message, from MAIL FROM to the end of data reply'),
+    'smtp_traffic_gen_pacing_lag_seconds': ('histogram', 'How late each message was sent against the pacing schedule'),
+    'smtp_traffic_gen_backoff_seconds_total': ('counter', 'Time spent waiting before retrying a message or reconnecting, summed over all connections'),
+    'smtp_traffic_gen_generate_seconds_total': ('counter', 'Time spent generating messages'),
+    'smtp_traffic_gen_sending_seconds_total': ('counter', 'Time spent sending messages, summed over all connections'),
+}
+
+
+class Histogram:
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.sum += v
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+
+# -----------------------------------------------------------------------------
+# A set of counters and histograms, keyed by name and labels. Mergeable, so results from worker processes can be combined.
+# -----------------------------------------------------------------------------
+class Metrics:
+    def __init__(self):
+        self.counters = {} # (name, labels) -> value, where labels is a tuple of (label, value) pairs
+        self.histograms = {} # (name, labels) -> Histogram
+
+    def inc(self, name, value = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        h = self.histograms.get(key)
+        if h is None:
+            h = self.histograms[key] = Histogram()
+        h.observe(value)
+
+    def merge(self, other):
+        for key, v in other.counters.items():
+            self.counters[key] = self.counters.get(key, 0) + v
+        for key, h in other.histograms.items():
+            if key in self.histograms:
+                self.histograms[key].merge(h)
+            else:
+                self.histograms[key] = Histogram(h.buckets)
+                self.histograms[key].merge(h)
+
+    # Prometheus text exposition format
+    def exposition(self):
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            if kind == 'counter':
+                series = sorted((k, v) for k, v in self.counters.items() if k[0] == name)
+            else:
+                series = sorted(((k, h) for k, h in self.histograms.items() if k[0] == name), key=lambda kh: kh[0])
+            if not series:
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for (_, labels), v in series:
+                if kind == 'counter':
+                    lines.append(f'{name}{format_labels(labels)} {v}')
+                else:
+                    cumulative = 0
+                    for le, c in zip(v.buckets + ('+Inf',), v.counts):
+                        cumulative += c
+                        lines.append(f'{name}_bucket{format_labels(labels + (("le", str(le)),))} {cumulative}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {v.sum}')
+                    lines.append(f'{name}_count{format_labels(labels)} {v.count}')
+        return '\n'.join(lines) + '\n'
+
+    # Write atomically, so the node_exporter textfile collector never sees a partial file
+    def write_textfile(self, path):
+        tmp = f'{path}.{os.getpid()}'
+        with open(tmp, 'w') as f:
+            f.write(self.exposition())
+        os.replace(tmp, path)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+
+# -----------------------------------------------------------------------------
+# Minimal HTTP endpoint for Prometheus to scrape. metrics_fn returns the current Metrics. Local only unless another
+# host (or '' for all interfaces) is given.
+# -----------------------------------------------------------------------------
+async def serve_metrics(metrics_fn, port, host = 'localhost'):
+    async def handle(reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass # skip request headers
+            if request.split(b' ')[1:2] in ([b'/metrics'], [b'/']):
+                status, body = '200 OK', metrics_fn().exposition().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write(f'HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host or None, port)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+#
+# First and last names from 1990 US Census data, with their frequencies, cached in a compact binary file so each run
+# can sample them without re-reading the census files. The cache is built from the `names` package's data the first
+# time it's needed, or by running this file.
+#
+# File layout: MAGIC, then uint32 counts of first and last names, then for each list its cumulative weights (uint32 x n)
+# and the offsets of each name in its text (uint32 x n+1), then the two texts (utf-8). All little-endian.
+
+import os, mmap, struct, random, bisect, time
+from array import array
+
+MAGIC = b'NAMETBL1'
+HEADER = struct.Struct('<8sII')
+NAME_TABLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'names.table')
+
+
+# -----------------------------------------------------------------------------
+# One list of names, as views into the mapped file
+# -----------------------------------------------------------------------------
+class NameList:
+    def __init__(self, cumulative: memoryview, offsets: memoryview, text: memoryview):
+        self.cumulative = cumulative
+        self.offsets = offsets
+        self.text = text
+        self.total = cumulative[-1] if len(cumulative) else 0
+
+    def __len__(self):
+        return len(self.cumulative)
+
+    def __getitem__(self, i):
+        return str(self.text[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+    # Index of a name chosen at random, in proportion to how common it is
+    def sample(self, rng: random.Random = None):
+        return bisect.bisect_right(self.cumulative, int((rng or random).random() * self.total))
+
+
+class NameTable:
+    def __init__(self, path = NAME_TABLE):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n_first, n_last = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a name table')
+        words = memoryview(self.mm)[HEADER.size:HEADER.size + 4 * (2 * n_first + 2 * n_last + 2)].cast('I')
+        first_cum, first_off = words[:n_first], words[n_first:2 * n_first + 1]
+        pos = 2 * n_first + 1
+        last_cum, last_off = words[pos:pos + n_last], words[pos + n_last:pos + 2 * n_last + 1]
+        text = HEADER.size + 4 * len(words)
+        view = memoryview(self.mm)
+        self.first = NameList(first_cum, first_off, view[text:text + first_off[-1]])
+        text += first_off[-1]
+        self.last = NameList(last_cum, last_off, view[text:text + last_off[-1]])
+
+
+# Read a census file: lines of name, frequency (percent), cumulative frequency, rank. Weights are taken from the
+# cumulative column, like the `names` package does, as the frequencies are rounded to zero for rarer names.
+def read_census(path, scale):
+    entries = []
+    prev = 0.0
+    with open(path) as f:
+        for line in f:
+            name, _, cumulative, _ = line.split()
+            entries.append((name.capitalize(), float(cumulative) - prev))
+            prev = float(cumulative)
+    return [(name, weight * scale / prev) for name, weight in entries]
+
+
+def pack_names(entries):
+    cumulative, offsets, text = array('I'), array('I', [0]), bytearray()
+    c = 0.0
+    for name, weight in entries:
+        c += weight
+        cumulative.append(int(c))
+        text += name.encode('utf-8')
+        offsets.append(len(text))
+    return cumulative, offsets, bytes(text)
+
+
+# Build the cache file from the `names` package's census data. Male and female first names are equally likely,
+# as with names.get_first_name().
+def build_name_table(path = NAME_TABLE):
+    import names
+    first = read_census(names.FILES['first:male'], 2 ** 29) + read_census(names.FILES['first:female'], 2 ** 29)
+    last = read_census(names.FILES['last'], 2 ** 31)
+    first_cum, first_off, first_text = pack_names(first)
+    last_cum, last_off, last_text = pack_names(last)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(first), len(last)))
+        for a in (first_cum, first_off, last_cum, last_off):
+            f.write(a.tobytes())
+        f.write(first_text)
+        f.write(last_text)
+    os.replace(tmp, path) # so concurrent runs never see a partial file
+    return len(first), len(last)
+
+
+_name_table = None
+
+# The shared name table, opened when first needed (and built, if there's no cache yet)
+def name_table(path = NAME_TABLE):
+    global _name_table
+    if _name_table is None:
+        if not os.path.exists(path):
+            build_name_table(path)
+        _name_table = NameTable(path)
+    return _name_table
+
+
+# -----------------------------------------------------------------------------
+# Main code - (re)build the cache, and time sampling from it
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    t = time.perf_counter()
+    n_first, n_last = build_name_table()
+    print(f'Wrote {n_first} first names and {n_last} last names to {NAME_TABLE} ({os.path.getsize(NAME_TABLE) / 1e6:.1f} MB) '
+          f'in {time.perf_counter() - t:.3f}s')
+    t = time.perf_counter()
+    table = NameTable()
+    print(f'Opened in {(time.perf_counter() - t) * 1e3:.3f}ms')
+    n = 100000
+    t = time.perf_counter()
+    counts = {}
+    for _ in range(n):
+        name = table.last[table.last.sample()]
+        counts[name] = counts.get(name, 0) + 1
+    print(f'{n} last names sampled in {time.perf_counter() - t:.3f}s. Most common:',
+          ', '.join(f'{name} {100 * c / n:.2f}%' for name, c in sorted(counts.items(), key=lambda x: -x[1])[:5]))
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+#
+# Fast weighted random sampling
+
+import random, math, hashlib
+
+# -----------------------------------------------------------------------------
+# Walker/Vose alias table: O(1) weighted draws, after O(n) setup
+# -----------------------------------------------------------------------------
+class AliasSampler:
+    def __init__(self, weights: list, rng: random.Random = None):
+        n = len(weights)
+        total = sum(weights)
+        self.n = n
+        self.rng = rng # None = the random module's shared generator, looked up when drawing so the sampler can be pickled
+        self.prob = [0.0] * n
+        self.alias = list(range(n))
+        scaled = [w * n / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        # anything left over is (to within rounding error) exactly 1.0
+        for i in small + large:
+            self.prob[i] = 1.0
+
+    # Return a random index, with probability proportional to its weight
+    def sample(self):
+        u = (self.rng or random).random() * self.n
+        i = int(u)
+        return i if u - i < self.prob[i] else self.alias[i]
+
+    # Return a list of k random indices. The fractional part of each draw picks between the column and its alias,
+    # so only one random number is needed per index.
+    def sample_n(self, k):
+        n, prob, alias, rand = self.n, self.prob, self.alias, (self.rng or random).random
+        result = []
+        for _ in range(k):
+            u = rand() * n
+            i = int(u)
+            result.append(i if u - i < prob[i] else alias[i])
+        return result
+
+
+# -----------------------------------------------------------------------------
+# Bounded Zipf distribution over ranks 0..n-1: rank r drawn with probability ~ 1/(r+1)^s. Uses the inverse CDF of the
+# continuous power law over [0.5, n+0.5], rounding to the nearest rank, so needs no table however large n is.
+# -----------------------------------------------------------------------------
+class ZipfSampler:
+    def __init__(self, n, s = 1.0, rng: random.Random = None):
+        self.n = n
+        self.s = s
+        self.rng = rng # None = the random module's shared generator
+        if s == 1:
+            self.low, self.span = 0.0, math.log(2 * n + 1)
+        else:
+            self.low = 0.5 ** (1 - s)
+            self.span = (n + 0.5) ** (1 - s) - self.low
+
+    def sample_n(self, k):
+        n, low, span, rand = self.n, self.low, self.span, (self.rng or random).random
+        if self.s == 1:
+            return [min(n - 1, int(0.5 * math.exp(rand() * span) + 0.5) - 1) for _ in range(k)]
+        e = 1 / (1 - self.s)
+        return [min(n - 1, int((low + rand() * span) ** e + 0.5) - 1) for _ in range(k)]
+
+
+# -----------------------------------------------------------------------------
+# A keyed pseudo-random permutation of range(n), in constant memory: a balanced Feistel network over the smallest
+# even number of bits that covers n, repeated ("cycle walking") until the result falls inside the range.
+# -----------------------------------------------------------------------------
+class Permutation:
+    def __init__(self, n, key, rounds = 4):
+        self.n = n
+        bits = max(2, (n - 1).bit_length())
+        self.half = (bits + 1) // 2
+        self.mask = (1 << self.half) - 1
+        seed = int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), 'little')
+        self.keys = [mix64(seed + i) for i in range(rounds)]
+
+    def __getitem__(self, i):
+        half, mask, keys = self.half, self.mask, self.keys
+        while True:
+            left, right = i >> half, i & mask
+            for k in keys:
+                left, right = right, left ^ (mix64(right ^ k) & mask)
+            i = (left << half) | right
+            if i < self.n:
+                return i
+
+
+# splitmix64's finalizer: a fast, well-mixed 64-bit hash of an integer
+def mix64(x):
+    x = (x + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return x ^ (x >> 31)
+
+
+# -----------------------------------------------------------------------------
+# Main code - for testing
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    weights = [40, 30, 20, 7, 2, 1]
+    sampler = AliasSampler(weights)
+    n = 1000000
+    counts = [0] * len(weights)
+    for i in sampler.sample_n(n):
+        counts[i] += 1
+    for w, c in zip(weights, counts):
+        print(f'weight {w / sum(weights):.3f} observed {c / n:.3f}')
+
+    n = 1000003
+    p = Permutation(n, 'test')
+    assert len(set(p[i] for i in range(n))) == n
+    print(f'Permutation of {n}: first few {[p[i] for i in range(5)]}')
+    z = ZipfSampler(n, 1.0)
+    ranks = z.sample_n(1000000)
+    print(f'Zipf s=1.0 over {n}: rank 0 {ranks.count(0) / len(ranks):.3f}, rank 1 {ranks.count(1) / len(ranks):.3f}, '
+          f'{len(set(ranks))} distinct in {len(ranks)} draws')
@@ -2,80 +2,16 @@
 #
 # SMTP Traffic Generator
 
-import sys, time, asyncio, datetime, argparse, re
-from aiosmtplib import SMTP
-from aiosmtplib.errors import SMTPException
-from typing import Iterator
+import time
+process_start = time.perf_counter() # before the other imports, so startup time includes them
+
+import sys, os, asyncio, datetime, argparse, re, random, signal, atexit
+from multiprocessing import Pool, Process
 
 from emailcontent import *
 from trafficmodel import *
-
-#Print to stderr - see https://stackoverflow.com/a/14981125/8545455
-def eprint(*args, **kwargs):
-    print(*args, file=sys.stderr, **kwargs)
-
-
-# -----------------------------------------------------------------------------
-# async SMTP email sending
-# -----------------------------------------------------------------------------
-async def send_msgs_async(msgs: list, host='localhost', port=25, snooze = 0.0, username=None, password=None, headers={}):
-    try:
-        # Don't attempt SSL from start of connection, but allow STARTTLS (default) with loose certs
-        smtp = SMTP(hostname=host, port=port, use_tls=False, validate_certs=False)
-        await smtp.connect()
-        if username and password:
-            code, msg = await smtp.auth_login(username, password)
-            if code <200 or code >299:
-                raise(code, msg)
-
-        for msg in msgs:
-            t1 = time.perf_counter()
-            for hdr, value in headers.items():
-                msg.add_header(hdr, value)
-            errors, etext = await smtp.send_message(msg)
-            if snooze > 0:
-                # Adjust for elapsed time to send message
-                t2 = time.perf_counter()
-                this_snooze = max(0, snooze - t2 + t1)
-                time.sleep(this_snooze)
-            if errors:
-                # this happens if mutltiple recipients, with some accepted & some rejected - see
-                # https://aiosmtplib.readthedocs.io/en/latest/reference.html#aiosmtplib.SMTP.sendmail
-                eprint(errors, etext)
-
-    except SMTPException as e:
-        eprint('{}: {}'.format(type(e), str(e)))
-
-    finally:
-        try:
-            await smtp.quit()
-        finally:
-            # Should be closed as we asked to QUIT, but if it's not, then close now
-            if smtp.is_connected:
-                await smtp.close()
-
-# f = an iterator (such as a generator function) that will yield the messages to be sent.
-# Per-connection settings such as host and port are passed onwards via kwargs.
-async def send_batch(f: Iterator, messages_per_connection = 100, max_connections = 20, **kwargs):
-    batch = [[] for _ in range(max_connections)]
-    b_id = 0 # round-robin distribution of messages to batch
-    coroutines = []
-    for i in f:
-        batch[b_id].append(i)
-        if len(batch[b_id]) >= messages_per_connection:
-            coroutines.append(send_msgs_async(batch[b_id], **kwargs))
-            batch[b_id] = []
-        b_id = (b_id+1) % max_connections
-        # when a full set of coroutines are ready, dispatch them
-        if len(coroutines) >= max_connections:
-            await asyncio.gather(*coroutines)
-            coroutines = []
-
-    # handle any remnant
-    for this_batch in batch:
-        coroutines.append(send_msgs_async(this_batch, **kwargs))
-    if(coroutines):
-        await asyncio.gather(*coroutines)
+from smtpsender import *
+from spool import *
 
 
 # Validate and split an input string. Separator can be = or :
@@ -86,6 +22,225 @@ def validate_split_arg(arg_value):
     return parts[0], parts[1]
 
 
+# Parse a --server target, host[:port][,weight=W][,max=N]
+def validate_server_arg(arg_value):
+    hostport, *options = arg_value.split(',')
+    host, _, port = hostport.partition(':')
+    target = Target(host, int(port) if port.isdigit() else None) # the default port depends on --tls
+    if not host or (port and not port.isdigit()):
+        raise argparse.ArgumentTypeError("must be in the format 'host[:port][,weight=W][,max=N]'")
+    for option in options:
+        k, v = validate_split_arg(option)
+        try:
+            if k == 'weight':
+                target.weight = float(v)
+            elif k == 'max':
+                target.max_connections = int(v)
+            else:
+                raise ValueError
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"unknown server option '{option}'")
+    if target.weight <= 0 or (target.max_connections is not None and target.max_connections < 1):
+        raise argparse.ArgumentTypeError('weight and max must be positive')
+    return target
+
+
+# With --daily-volume, scheduled arrivals up to this many seconds past are still sent, as cron starts runs a little after
+# the minute, and the daemon's batches start a little after it too
+LATE_ARRIVALS = 1.0
+
+# -----------------------------------------------------------------------------
+# The messages to send each minute in daemon mode, for one worker's share of the volume
+# -----------------------------------------------------------------------------
+class MinuteBatches:
+    def __init__(self, names: NamesCollection, content: EmailContent, bounces: BounceCollection, daily_volume = None, volume = None, recipients = 1,
+            traffic_model: Traffic = None, arrivals = None, resolution = 1.0, burst_size = 10):
+        self.names = names
+        self.content = content
+        self.bounces = bounces
+        self.daily_volume = daily_volume
+        self.volume = volume
+        self.recipients = recipients # per message
+        self.traffic_model = traffic_model or Traffic()
+        self.arrivals = arrivals # None, or how to time each message: 'even', 'poisson' or 'bursty'
+        self.resolution = resolution # of the day's schedule, in seconds
+        self.burst_size = burst_size # mean messages per burst
+
+    # Volume for the minute starting at datetime t
+    def volume_this_minute(self, t: datetime.datetime):
+        if self.daily_volume:
+            return self.traffic_model.volume_this_minute(t, daily_vol = self.daily_volume)
+        else:
+            return self.volume
+
+    def messages(self, n, bounce = True):
+        return rand_messages(n, self.names, self.content, self.bounces, recipients=self.recipients, bounce=bounce)
+
+    # Times for each message in the minute starting at datetime t, in seconds from t; or None to leave the pacing to --duration.
+    # A set volume is spread over the minute from offset seconds.
+    def arrivals_this_minute(self, t: datetime.datetime, offset = 0.0):
+        if not self.arrivals:
+            return None
+        if self.daily_volume:
+            return self.traffic_model.arrivals_this_minute(t, self.daily_volume, self.arrivals, self.resolution, self.burst_size)
+        return self.traffic_model.arrivals(self.volume_this_minute(t), self.arrivals, self.burst_size, offset)
+
+    # The batch for the minute that datetime t is in. A run starting part way through a minute sends only the rest of it,
+    # rather than a burst of everything it missed: the day's schedule drops arrivals more than LATE_ARRIVALS seconds before t,
+    # and a set volume is spread over what is left of the minute.
+    def __call__(self, t: datetime.datetime):
+        start = t.replace(second=0, microsecond=0)
+        now = (t - start).total_seconds()
+        arrivals = self.arrivals_this_minute(start, now)
+        if arrivals is not None and self.daily_volume:
+            arrivals = [a for a in arrivals if a >= now - LATE_ARRIVALS]
+        n = len(arrivals) if arrivals is not None else self.volume_this_minute(start)
+        return n, self.messages(n), arrivals
+
+    def schedule(self):
+        return dict(traffic_model = self.traffic_model, arrivals = self.arrivals, resolution = self.resolution, burst_size = self.burst_size)
+
+    # Divide the volume between k workers
+    def shares(self, k):
+        if self.daily_volume:
+            return [MinuteBatches(self.names, self.content, self.bounces, daily_volume = v, recipients = self.recipients, **self.schedule())
+                for v in split(self.daily_volume, k)]
+        else:
+            return [MinuteBatches(self.names, self.content, self.bounces, volume = v, recipients = self.recipients, **self.schedule())
+                for v in split(self.volume, k)]
+
+
+# -----------------------------------------------------------------------------
+# Messages replayed from a spool file made with --generate, instead of generated. Each minute carries on through the
+# spool from where the last one stopped. Without a volume, each batch is the whole spool (or this worker's share of it).
+# -----------------------------------------------------------------------------
+class SpoolBatches(MinuteBatches):
+    def __init__(self, path, daily_volume = None, volume = None, start = 0, step = 1, **schedule):
+        super().__init__(None, None, None, daily_volume, volume, **schedule)
+        self.path = path
+        self.spool = None # opened when first needed, so each worker process maps the file itself
+        self.start = start
+        self.step = step
+        self.offset = 0
+
+    def open(self):
+        if self.spool is None:
+            self.spool = Spool(self.path)
+        return self.spool
+
+    def volume_this_minute(self, t: datetime.datetime):
+        if self.daily_volume or self.volume is not None:
+            return super().volume_this_minute(t)
+        return len(range(self.start, len(self.open()), self.step))
+
+    def messages(self, n):
+        msgs = self.open().messages(n, self.start, self.step, self.offset)
+        self.offset += n
+        return msgs
+
+    # Worker i replays every k'th message, starting with message i
+    def shares(self, k):
+        if self.daily_volume:
+            volumes = [dict(daily_volume = v) for v in split(self.daily_volume, k)]
+        elif self.volume is not None:
+            volumes = [dict(volume = v) for v in split(self.volume, k)]
+        else:
+            volumes = [{}] * k
+        return [SpoolBatches(self.path, start = i, step = k, **v, **self.schedule()) for i, v in enumerate(volumes)]
+
+
+# Divide n into k near-equal integer parts
+def split(n, k):
+    return [n // k + (1 if i < n % k else 0) for i in range(k)]
+
+
+# Each worker's list of servers. A server's max connections are split between the workers, and a worker whose share is
+# zero leaves that server out. The splits are staggered, so that the odd connections of each server go to different workers.
+def share_servers(servers: list, k):
+    shares = [[] for _ in range(k)]
+    offset = 0
+    for t in servers:
+        if t.max_connections:
+            parts = split(t.max_connections, k)
+            for i in range(k):
+                if n := parts[(i - offset) % k]:
+                    shares[i].append(Target(t.host, t.port, t.weight, n))
+            offset += t.max_connections
+        else:
+            for i in range(k):
+                shares[i].append(Target(t.host, t.port, t.weight))
+    return shares
+
+
+# -----------------------------------------------------------------------------
+# Worker processes, each with its own share of the volume, event loop and connections
+# -----------------------------------------------------------------------------
+def init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the parent handles Ctrl-C, and stops the workers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL) # not the parent's handler, inherited on fork
+
+# Forked workers inherit the parent's random state, so always reseed them to avoid identical message streams (and schedules)
+def seed_worker(seed, worker_id, batches = None):
+    random.seed(f'{seed}-{worker_id}' if seed is not None else None)
+    if batches:
+        batches.traffic_model.seed(f'{seed}-{worker_id}-traffic' if seed is not None else None)
+
+# With arrivals, the worker times its own share of this minute's traffic, so n is not used
+def send_worker_process(worker_id, seed, batches, n, rate, mail_params):
+    seed_worker(seed, worker_id, batches)
+    if batches.arrivals:
+        n, msgs, arrivals = batches(datetime.datetime.now())
+        return asyncio.run(send_batch(msgs, arrivals=shift_arrivals(arrivals), **mail_params))
+    return asyncio.run(send_batch(batches.messages(n), rate=rate, **mail_params))
+
+# Arrival times from the start of the minute, made relative to now. Those just past (see LATE_ARRIVALS) are sent straight away.
+def shift_arrivals(arrivals):
+    return [a - time.time() % 60 for a in arrivals]
+
+# Each worker serves its own metrics, on consecutive ports or to separate files
+def daemon_worker_process(worker_id, seed, batches, duration, mail_params, metrics_port, metrics_file, metrics_host):
+    init_worker()
+    seed_worker(seed, worker_id, batches)
+    asyncio.run(run_daemon(batches, duration=duration, label=f'worker {worker_id}: ',
+        metrics_port=metrics_port + worker_id if metrics_port else None, metrics_host=metrics_host,
+        metrics_file=worker_metrics_file(metrics_file, worker_id) if metrics_file else None, **mail_params))
+
+# e.g. gen.prom -> gen-1.prom, so the textfile collector picks up every worker's file
+def worker_metrics_file(path, worker_id):
+    base, ext = os.path.splitext(path)
+    return f'{base}-{worker_id}{ext}'
+
+
+# Profile this process from here until it exits (by any route), then save the stats and show the most expensive calls.
+# Work done in worker processes is not included, so profile with --workers 1.
+def start_profile(path):
+    import cProfile
+    profile = cProfile.Profile()
+    profile.enable()
+    atexit.register(report_profile, profile, path)
+
+def report_profile(profile, path):
+    import pstats
+    profile.disable()
+    profile.dump_stats(path)
+    eprint(f'Profile written to {path}. Top calls by cumulative time:')
+    pstats.Stats(profile, stream=sys.stderr).sort_stats('cumulative').print_stats(20)
+
+# Trace memory allocations from here until exit, then show the peak and where the memory still in use was allocated
+def start_tracemalloc(frames = 5):
+    import tracemalloc
+    tracemalloc.start(frames)
+    atexit.register(report_tracemalloc)
+
+def report_tracemalloc(top = 10):
+    import tracemalloc
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    eprint(f'Memory traced: {current / 1e6:.1f} MB in use, peak {peak / 1e6:.1f} MB. Top allocations:')
+    for stat in snapshot.statistics('lineno')[:top]:
+        eprint(f'  {stat}')
+
 # -----------------------------------------------------------------------------
 # Main code
 # -----------------------------------------------------------------------------
@@ -93,68 +248,222 @@ if __name__ == "__main__":
     start_time = time.perf_counter()
     parser = argparse.ArgumentParser(
         description='Generate SMTP traffic with headers to cause some messages to bounce back from the sink')
-    parser.add_argument('--bounces', type=argparse.FileType('r'), required=True, help='bounce configuration file (csv)')
-    parser.add_argument('--sender-subjects', type=argparse.FileType('r'), required=True, help='senders and subjects configuration file (csv)')
-    parser.add_argument('--html-content', type=argparse.FileType('r'), required=True, help='html email content with placeholders')
-    parser.add_argument('--txt-content', type=argparse.FileType('r'), required=True, help='plain text email content with placeholders')
-    exclusive_group = parser.add_mutually_exclusive_group(required=True)
+    parser.add_argument('--bounces', type=argparse.FileType('r'), help='bounce configuration file (csv)')
+    parser.add_argument('--sender-subjects', type=argparse.FileType('r'), help='senders and subjects configuration file (csv)')
+    parser.add_argument('--html-content', type=argparse.FileType('r'), help='html email content with placeholders')
+    parser.add_argument('--txt-content', type=argparse.FileType('r'), help='plain text email content with placeholders')
+    exclusive_group = parser.add_mutually_exclusive_group()
     exclusive_group.add_argument('--daily-volume', type=int, help='daily volume, apply traffic model')
     exclusive_group.add_argument('--volume', type=int, help='exact volume for this run')
     parser.add_argument('--yahoo-backoff', type=float, help='Yahoo-specific bounce rates to cause backoff mode')
     parser.add_argument('--max-connections', type=int, default=20, help='Maximum number of SMTP connections to open')
     parser.add_argument('--messages-per-connection', type=int, default=100, help='Maximum number of messages to send on a connection')
     parser.add_argument('--duration', type=int, default = 0, help='duration to cadence this send, default is "as fast as possible"')
-    parser.add_argument('--server', type=str, default = 'localhost:25', help='server:port to inject messages to')
+    parser.add_argument('--arrivals', choices=['even', 'poisson', 'bursty'],
+        help='send each message at its own scheduled time in the minute, spaced evenly or as Poisson or bursty arrivals (instead of --duration)')
+    parser.add_argument('--resolution', type=float, default=1.0, help='with --arrivals and --daily-volume: seconds per interval of the day\'s schedule')
+    parser.add_argument('--burst-size', type=float, default=10, help='with --arrivals bursty: mean messages per burst')
+    parser.add_argument('--traffic-profile', type=argparse.FileType('r'),
+        help='daily traffic curves and their time zones (csv), instead of the default traffic_profile.csv')
+    parser.add_argument('--server', type=validate_server_arg, nargs='+', default = [Target('localhost', None)],
+        help='server:port to inject messages to. Several can be given as host[:port][,weight=W][,max=N], sharing the connections by weight')
+    parser.add_argument('--tls', choices=['none', 'starttls', 'implicit'],
+        help='none, starttls (required), or implicit TLS from connecting, as on port 465 (the default port with this). Default: STARTTLS if offered')
+    parser.add_argument('--tls-resumption', choices=['on', 'off'], default='on', help='resume earlier TLS sessions with the same server, for shorter handshakes')
     parser.add_argument('--auth-user', type=str, help='authentication user name')
     parser.add_argument('--auth-pass', type=str, help='authentication password')
     parser.add_argument('--add-header', type=validate_split_arg, nargs='*', help='add a header on each email')
+    parser.add_argument('--recipient-space', type=int,
+        help='send to this many distinct, stable recipients per domain (e.g. millions), instead of a small set of random names')
+    parser.add_argument('--recipient-popularity', choices=['uniform', 'zipf'], default='uniform',
+        help='with --recipient-space: how often each recipient is chosen - all alike, or a few very often and most rarely')
+    parser.add_argument('--zipf-exponent', type=float, default=1.0, help='with --recipient-popularity zipf: higher values concentrate on fewer recipients')
+    parser.add_argument('--recipients-per-message', type=int, default=1, help='recipients per message, all on the same domain, in one transaction')
+    parser.add_argument('--pipelining', action='store_true', help='pipeline each transaction\'s commands (RFC 2920), if the server offers PIPELINING')
+    parser.add_argument('--chunking', action='store_true', help='send messages with BDAT (RFC 3030), if the server offers CHUNKING')
+    parser.add_argument('--retries', type=int, default=2, help='times to retry a message after a 4xx reply or a failed connection')
+    parser.add_argument('--max-backoff', type=float, default=10.0, help='longest wait in seconds before reconnecting or retrying, backing off exponentially')
+    parser.add_argument('--daemon', action='store_true', help='keep running, sending a batch each minute over persistent connections (replaces cron)')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes to share the volume and connections between')
+    parser.add_argument('--seed', type=str, help='random seed, for a repeatable message stream (each worker derives its own)')
+    parser.add_argument('--metrics-port', type=int, help='daemon mode: serve Prometheus metrics over HTTP on this port (one port per worker, counting up)')
+    parser.add_argument('--metrics-host', type=str, default='localhost', help='daemon mode: address to serve metrics on (default: localhost; "" for all interfaces)')
+    parser.add_argument('--metrics-file', type=str, help='write Prometheus metrics to this file, for the node_exporter textfile collector')
+    parser.add_argument('--stress', action='store_true',
+        help='find the most messages/second the servers can sustain, ramping the rate and connections (up to --max-connections) until latency or 4xx replies degrade. Messages are sent without bounce headers')
+    parser.add_argument('--stress-rate', type=float, default=10.0, help='with --stress: messages/second to start at')
+    parser.add_argument('--stress-increase', type=float, help='with --stress: messages/second to add each step, once past the initial doubling (default: 5%% of the rate where it first backs off)')
+    parser.add_argument('--stress-step', type=float, default=10.0, help='with --stress: seconds per step')
+    parser.add_argument('--stress-backoffs', type=int, default=3, help='with --stress: stop after backing off this many times')
+    parser.add_argument('--stress-max-latency', type=float, help='with --stress: p95 send latency in ms counted as degraded (default: 4x the lowest seen, and at least 50ms)')
+    parser.add_argument('--stress-max-tempfail', type=float, default=5.0, help='with --stress: percentage of 4xx replies or lost messages counted as degraded')
+    parser.add_argument('--profile', type=str, metavar='FILE', help='profile the run with cProfile, writing the stats to FILE (for pstats or snakeviz) and showing the top calls')
+    parser.add_argument('--tracemalloc', action='store_true', help='trace memory allocations, showing the peak and the top allocation sites at exit')
+    spool_group = parser.add_mutually_exclusive_group()
+    spool_group.add_argument('--generate', type=str, metavar='SPOOL', help='write the messages to this spool file, instead of sending them')
+    spool_group.add_argument('--replay', type=str, metavar='SPOOL', help='send messages from a spool file made with --generate (default volume: the whole spool)')
 
     args = parser.parse_args()
-    bounces = BounceCollection(args.bounces, args.yahoo_backoff)
-    content = EmailContent(args.sender_subjects, args.html_content, args.txt_content)
-    if args.daily_volume:
-        traffic_model = Traffic()
-        batch_size = traffic_model.volume_this_minute(datetime.datetime.now(), daily_vol = args.daily_volume)
-    elif args.volume:
-        batch_size = args.volume
-
-    nNames = 100 # should be enough for batches up to a few thousand
-    print('Getting {} randomized real names from US 1990 census data'.format(nNames))
-    names = NamesCollection(nNames) # Get some pseudorandom recipients
+    for t in args.server:
+        if t.port is None:
+            t.port = 465 if args.tls == 'implicit' else 25
+    if args.profile:
+        start_profile(args.profile)
+    if args.tracemalloc:
+        start_tracemalloc()
+    if args.recipient_space is not None and args.recipient_space < 1:
+        parser.error('--recipient-space must be at least 1')
+    if args.zipf_exponent <= 0:
+        parser.error('--zipf-exponent must be positive')
+    if args.arrivals and args.duration:
+        parser.error('--duration does not apply with --arrivals, which times each message itself')
+    if args.stress and (args.daemon or args.generate or args.replay or args.arrivals or args.duration or args.workers > 1):
+        parser.error('--stress runs on its own, without --daemon, --generate, --replay, --arrivals, --duration or --workers')
+    if args.stress and (args.stress_rate <= 0 or args.stress_step <= 0 or args.stress_backoffs < 1):
+        parser.error('--stress-rate, --stress-step and --stress-backoffs must be positive')
+    if args.resolution <= 0 or abs(60 / args.resolution - round(60 / args.resolution)) > 1e-9: # not %, as 60 % 0.1 isn't 0 in floating point
+        parser.error('--resolution must divide a minute evenly')
+    # The traffic model has its own random numbers, seeded separately from the message content
+    schedule = dict(traffic_model = Traffic(args.traffic_profile, f'{args.seed}-traffic' if args.seed is not None else None),
+        arrivals = args.arrivals, resolution = args.resolution, burst_size = args.burst_size)
+    if args.replay:
+        batches = SpoolBatches(args.replay, daily_volume = args.daily_volume, volume = args.volume, **schedule)
+        print(f'Replaying {len(batches.open())} messages from {args.replay}')
+    else:
+        for arg in ('bounces', 'sender_subjects', 'html_content', 'txt_content'):
+            if getattr(args, arg) is None:
+                parser.error(f"the following arguments are required: --{arg.replace('_', '-')}")
+        if args.daily_volume is None and args.volume is None and not args.stress:
+            parser.error('one of the arguments --daily-volume --volume is required')
+        bounces = BounceCollection(args.bounces, args.yahoo_backoff)
+        content = EmailContent(args.sender_subjects, args.html_content, args.txt_content)
+
+        if args.seed is not None:
+            random.seed(args.seed)
+        if args.recipient_space:
+            print(f'Sending to {args.recipient_space} recipients per domain, {args.recipient_popularity} popularity')
+            names = RecipientSpace(args.recipient_space, args.recipient_popularity, args.zipf_exponent)
+        else:
+            nNames = 100 # should be enough for batches up to a few thousand
+            print('Getting {} randomized real names from US 1990 census data'.format(nNames))
+            names = NamesCollection(nNames) # Get some pseudorandom recipients
+
+        batches = MinuteBatches(names, content, bounces, daily_volume = args.daily_volume, volume = args.volume, recipients = args.recipients_per_message,
+            **schedule)
+    batch_size = batches.volume_this_minute(datetime.datetime.now())
 
     print('Done in {0:.3f}s.'.format(time.perf_counter() - start_time))
     print('Yahoo backoff bounce probability', args.yahoo_backoff)
 
-    if args.duration > 0:
-        elapsed_time = max(0, time.perf_counter() - start_time) # ensure monotonic
-        snooze = (args.duration - elapsed_time) / (batch_size / args.max_connections)
-    else:
-        snooze = 0
+    if args.generate:
+        seed_worker(args.seed, 0)
+        n = write_spool(args.generate, batches.messages(batch_size))
+        print(f'Wrote {n} messages to {args.generate} in {time.perf_counter() - start_time:.3f}s')
+        sys.exit(0)
+
+    if args.stress:
+        print(f"Stress test of {', '.join(str(t) for t in args.server)}: starting at {args.stress_rate:g} msg/s on 1 connection, "
+              f"up to {args.max_connections} connections, {args.stress_step:g}s steps", flush=True)
+        controller = AIMDController(args.stress_rate, 1, args.max_connections, args.stress_increase,
+            max_latency=args.stress_max_latency / 1000 if args.stress_max_latency else None, max_tempfail=args.stress_max_tempfail / 100)
+        seed_worker(args.seed, 0)
+        try:
+            # Without bounce headers, so that every 4xx reply is the servers' own
+            controller, steps = asyncio.run(run_stress(lambda n: batches.messages(n, bounce=False), controller, args.stress_step, args.stress_backoffs,
+                servers=args.server, username=args.auth_user, password=args.auth_pass, headers=dict(args.add_header) if args.add_header else {},
+                messages_per_connection=args.messages_per_connection, pipelining=args.pipelining, chunking=args.chunking, max_backoff=args.max_backoff,
+                tls=args.tls, tls_resumption=args.tls_resumption == 'on'))
+        except KeyboardInterrupt:
+            sys.exit(1)
+        print(stress_report(controller, steps))
+        sys.exit(0)
 
-    # Get host & port from the --server param
-    if ':' in args.server:
-        host, port = args.server.split(':')
+    if args.duration > 0 and batch_size > 0:
+        elapsed_time = max(0, time.perf_counter() - start_time) # ensure monotonic
+        rate = batch_size / max(args.duration - elapsed_time, 1) # messages per second, over all connections
     else:
-        host = args.server
-        port = '25'
+        rate = 0
 
     mail_params = {
-        'host': host,
-        'port': int(port),
+        'servers': args.server,
         'messages_per_connection': args.messages_per_connection,
         'max_connections': args.max_connections,
-        'snooze': snooze,
         'username': args.auth_user,
         'password': args.auth_pass,
         'headers': dict(args.add_header) if args.add_header else {},
+        'pipelining': args.pipelining,
+        'chunking': args.chunking,
+        'retries': args.retries,
+        'max_backoff': args.max_backoff,
+        'tls': args.tls,
+        'tls_resumption': args.tls_resumption == 'on',
     }
+    # Connections are shared out between the workers, at least one each, as are any per-server limits
+    if args.workers > args.max_connections:
+        parser.error(f'--workers {args.workers} is more than --max-connections {args.max_connections}, so some workers would have no connection')
+    worker_servers = share_servers(args.server, args.workers)
+    if not all(worker_servers):
+        parser.error(f'--workers {args.workers} is more than the servers\' max connections allow, so some workers would have no server')
+    worker_mail_params = [dict(mail_params, max_connections=c, servers=worker_servers[i])
+        for i, c in enumerate(split(args.max_connections, args.workers))]
+    servers = ', '.join(str(t) for t in args.server)
 
-    msgs = rand_messages(batch_size, names, content, bounces)
-    print(f"Sending {batch_size} messages, with auth-user: {mail_params['username']}, auth-pass: {mail_params['password']}")
-    print(f"Max {mail_params['max_connections']} SMTP connections to {mail_params['host']}:{mail_params['port']}, "
-          f"{mail_params['messages_per_connection']} max messages per connection, cadence {mail_params['snooze']:.4f} seconds per mail")
-    print(f"headers: {mail_params['headers']}")
-    print("Starting at", time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(time.time())) )
-    start_time = time.perf_counter()
-    asyncio.run(send_batch(msgs, **mail_params))
-    print(f"Done in {time.perf_counter() - start_time:.1f}s.")
+    # Treat SIGTERM like Ctrl-C, so that worker processes are stopped too
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if args.daemon:
+        print(f"Daemon mode, with auth-user: {mail_params['username']}, auth-pass: {mail_params['password']}")
+        print(f"Max {mail_params['max_connections']} persistent SMTP connections to {servers}, "
+              f"{mail_params['messages_per_connection']} max messages per connection, "
+              + (f"{args.arrivals} arrivals" if args.arrivals else f"duration {args.duration}s") + " per minute, "
+              + f"{args.workers} worker process(es)")
+        print(f"headers: {mail_params['headers']}")
+        print(f"recipients per message: {args.recipients_per_message}, pipelining: {args.pipelining}, chunking: {args.chunking}, "
+              f"tls: {args.tls or 'starttls if offered'}, resumption: {args.tls_resumption}")
+        print("Starting at", time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(time.time())), flush=True)
+        try:
+            if args.workers > 1:
+                workers = [Process(target=daemon_worker_process,
+                        args=(i, args.seed, b, args.duration, p, args.metrics_port, args.metrics_file, args.metrics_host))
+                    for i, (b, p) in enumerate(zip(batches.shares(args.workers), worker_mail_params))]
+                for w in workers:
+                    w.start()
+                try:
+                    for w in workers:
+                        w.join()
+                finally:
+                    # SIGTERM lets each worker close its connections cleanly
+                    for w in workers:
+                        w.terminate()
+                    for w in workers:
+                        w.join()
+            else:
+                seed_worker(args.seed, 0, batches)
+                asyncio.run(run_daemon(batches, duration=args.duration, metrics_port=args.metrics_port, metrics_file=args.metrics_file,
+                    metrics_host=args.metrics_host, **mail_params))
+        except KeyboardInterrupt:
+            print("Stopped at", time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(time.time())))
+    else:
+        print(f"Sending {batch_size} messages, with auth-user: {mail_params['username']}, auth-pass: {mail_params['password']}")
+        print(f"Max {mail_params['max_connections']} SMTP connections to {servers}, "
+              f"{mail_params['messages_per_connection']} max messages per connection, "
+              + (f"{args.arrivals} arrivals over the minute, " if args.arrivals else f"rate {rate:.1f} messages/second (0 = as fast as possible), ")
+              + f"{args.workers} worker process(es)")
+        print(f"headers: {mail_params['headers']}")
+        print(f"recipients per message: {args.recipients_per_message}, pipelining: {args.pipelining}, chunking: {args.chunking}, "
+              f"tls: {args.tls or 'starttls if offered'}, resumption: {args.tls_resumption}")
+        started = time.time()
+        print("Starting at", time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(started)) )
+        if args.workers > 1:
+            stats = SendStats()
+            with Pool(args.workers, initializer=init_worker) as pool:
+                for worker_stats in pool.starmap(send_worker_process, [(i, args.seed, b, n, rate * n / batch_size if batch_size else 0, p)
+                        for i, (b, n, p) in enumerate(zip(batches.shares(args.workers), split(batch_size, args.workers), worker_mail_params))]):
+                    stats.merge(worker_stats)
+        else:
+            stats = send_worker_process(0, args.seed, batches, batch_size, rate, mail_params)
+        # Arrivals cover the rest of the minute, from when the run started
+        print(stats.summary(stats.attempted / (60 - started % 60) if args.arrivals else rate))
+        if stats.first_connect is not None:
+            print(f'startup to first connection {stats.first_connect - process_start:.3f}s')
+        if args.metrics_file:
+            stats.metrics.write_textfile(args.metrics_file)
@@ -0,0 +1,896 @@
+#!/usr/bin/env python3
+#
+# SMTP sending - paced, queue-fed connection workers, for one-shot batches and daemon mode
+
+import sys, time, asyncio, datetime, signal, statistics, re, random, math, ssl
+from array import array
+from aiosmtplib import SMTP, SMTPResponse
+from aiosmtplib.errors import SMTPException, SMTPHeloError, SMTPRecipientsRefused, SMTPRecipientRefused, SMTPSenderRefused, \
+    SMTPDataError, SMTPResponseException, SMTPServerDisconnected, SMTPReadTimeoutError, SMTPNotSupported
+from typing import Callable, Iterator
+from email.message import EmailMessage
+from metrics import Metrics, serve_metrics
+
+#Print to stderr - see https://stackoverflow.com/a/14981125/8545455
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+# -----------------------------------------------------------------------------
+# Servers to send to, each with a weight and optional connection limit. A server that keeps failing is benched for a
+# while, and its connections go to the others.
+# -----------------------------------------------------------------------------
+class Target:
+    def __init__(self, host='localhost', port=25, weight=1.0, max_connections=None):
+        self.host = host
+        self.port = port
+        self.weight = weight
+        self.max_connections = max_connections # None = no limit
+        self.connections = 0 # sessions connecting or connected to this target
+        self.failures = 0 # in a row
+        self.benched_until = 0.0
+
+    def name(self):
+        return f'{self.host}:{self.port}'
+
+    def __str__(self):
+        return self.name() + (f' (weight {self.weight:g}' + (f', max {self.max_connections} connections' if self.max_connections else '') + ')'
+            if self.weight != 1 or self.max_connections else '')
+
+
+class TargetPool:
+    def __init__(self, targets: list, fail_threshold = 3, bench_time = 30.0):
+        # Each process needs its own copies, as the counts change
+        self.targets = [Target(t.host, t.port, t.weight, t.max_connections) for t in targets]
+        self.fail_threshold = fail_threshold # connection failures or 421 replies in a row, to bench a target
+        self.bench_time = bench_time # seconds
+
+    # Most connections that can be open at once
+    def capacity(self, n):
+        if all(t.max_connections for t in self.targets):
+            return min(n, sum(t.max_connections for t in self.targets))
+        return n
+
+    # Choose a target for a new connection, spreading connections in proportion to the weights. Benched targets are
+    # only used if no healthy one has room for another connection. Returns None if every target is at its limit.
+    def pick(self):
+        now = time.monotonic()
+        available = [t for t in self.targets if not t.max_connections or t.connections < t.max_connections]
+        candidates = [t for t in available if t.benched_until <= now] or available
+        if not candidates:
+            return None
+        t = min(candidates, key=lambda t: (t.connections + 1) / t.weight)
+        t.connections += 1
+        return t
+
+    def release(self, t: Target):
+        t.connections -= 1
+
+    def succeeded(self, t: Target):
+        t.failures = 0
+
+    def failed(self, t: Target):
+        t.failures += 1
+        if t.failures >= self.fail_threshold:
+            if t.benched_until <= time.monotonic():
+                eprint(f'{t.name()} is failing, not using it for {self.bench_time:.0f}s')
+            t.benched_until = time.monotonic() + self.bench_time
+            t.failures = 0
+
+
+# -----------------------------------------------------------------------------
+# One TLS context, shared by every connection in a process, so it is set up once rather than per connection.
+# Certificates aren't checked, as sinks and test servers mostly have self-signed ones. With resumption, each new
+# connection is offered the last session seen from the same server, so the server can skip the full handshake.
+# -----------------------------------------------------------------------------
+class ClientTLSContext(ssl.SSLContext):
+    def __new__(cls, resumption = True):
+        return super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+    def __init__(self, resumption = True):
+        self.check_hostname = False
+        self.verify_mode = ssl.CERT_NONE
+        self.resumption = resumption
+        self.resumable = {} # server hostname -> SSLSession
+
+    # Called by asyncio for each connection it wraps in TLS
+    def wrap_bio(self, incoming, outgoing, server_side = False, server_hostname = None, session = None):
+        if self.resumption and session is None:
+            session = self.resumable.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+    # Keep a connection's session for the next ones. With TLS 1.3 the server sends its session tickets after the handshake,
+    # so this is done once a reply has been read over TLS.
+    def remember(self, server_hostname, session):
+        if self.resumption and session is not None:
+            self.resumable[server_hostname] = session
+
+
+# -----------------------------------------------------------------------------
+# A persistent SMTP connection, which can be kept warm between batches. It connects to one of the pool's targets,
+# chosen afresh each time it reconnects.
+# -----------------------------------------------------------------------------
+class SMTPSession:
+    def __init__(self, host='localhost', port=25, username=None, password=None, messages_per_connection=100, pipelining=False, chunking=False,
+            retries=2, max_backoff=10.0, pool: TargetPool = None, tls = None, tls_context: ClientTLSContext = None):
+        self.pool = pool or TargetPool([Target(host, port)])
+        self.target = None # while connecting or connected
+        self.target_name = None # the most recent target, for stats
+        self.username = username
+        self.password = password
+        self.messages_per_connection = messages_per_connection
+        self.pipelining = pipelining # use PIPELINING (RFC 2920) if the server offers it
+        self.chunking = chunking # use BDAT (RFC 3030) if the server offers CHUNKING
+        self.retries = retries # further attempts at a message after a transient failure
+        self.max_backoff = max_backoff # longest wait before reconnecting or retrying, seconds
+        self.tls = tls # 'none', 'starttls' (required), 'implicit' (from connecting), or None for STARTTLS if offered
+        self.tls_context = tls_context or ClientTLSContext()
+        self.smtp = None
+        self.sent_on_connection = 0
+        self.connect_failures = 0 # in a row, for backing off
+        self.send_time = None # of the last message, from MAIL FROM to the final reply; None if it didn't get that far
+
+    def is_connected(self):
+        return self.smtp is not None and self.smtp.is_connected
+
+    # Open the connection, recording the time taken by each phase in stats. After failing to connect, wait longer
+    # each time before trying again.
+    async def connect(self, stats = None):
+        if self.connect_failures:
+            delay = backoff(self.connect_failures, self.max_backoff)
+            if stats:
+                stats.record_backoff(delay)
+            await asyncio.sleep(delay)
+        self.release()
+        while (target := self.pool.pick()) is None:
+            await asyncio.sleep(0.5) # all targets are at their connection limits
+        self.target, self.target_name = target, target.name()
+        try:
+            await self.open(stats)
+            self.connect_failures = 0
+            self.pool.succeeded(target)
+        except (SMTPException, OSError) as e:
+            if transient(e): # a refusal, such as AUTH with the wrong password, would be the same next time
+                self.connect_failures += 1
+                self.pool.failed(target)
+            await self.close() # don't leave a half-open connection, e.g. after failing AUTH
+            raise
+
+    def release(self):
+        if self.target:
+            self.pool.release(self.target)
+            self.target = None
+
+    async def open(self, stats = None):
+        # The phases are done one by one, rather than letting aiosmtplib do them all in connect(), so they can be timed.
+        implicit = self.tls == 'implicit'
+        self.smtp = SMTP(hostname=self.target.host, port=self.target.port, use_tls=implicit, start_tls=False, validate_certs=False,
+            tls_context=self.tls_context)
+        handshake = None
+        t = time.perf_counter()
+        await self.smtp.connect()
+        if stats and stats.first_connect is None:
+            stats.first_connect = time.perf_counter()
+        if implicit:
+            handshake = time.perf_counter() - t # including the TCP connect, which happens along with it
+        t = record_phase(stats, 'connect', t)
+        await self.ehlo()
+        t = record_phase(stats, 'ehlo', t)
+        if self.tls == 'starttls' and not self.smtp.supports_extension('starttls'):
+            raise SMTPNotSupported(f'STARTTLS is required, but {self.target.name()} does not offer it')
+        if self.tls == 'starttls' or (self.tls is None and self.smtp.supports_extension('starttls')):
+            await self.smtp.starttls()
+            handshake = time.perf_counter() - t
+            await self.ehlo()
+            t = record_phase(stats, 'starttls', t)
+        if handshake is not None:
+            ssl_object = self.smtp.transport.get_extra_info('ssl_object')
+            self.tls_context.remember(self.target.host, ssl_object.session)
+            if stats:
+                stats.record_tls(handshake, ssl_object.session_reused)
+        if self.username and self.password:
+            await self.smtp.auth_login(self.username, self.password)
+            t = record_phase(stats, 'auth', t)
+        if stats:
+            stats.metrics.inc('smtp_traffic_gen_connections_total')
+        self.sent_on_connection = 0
+
+    async def ehlo(self):
+        try:
+            await self.smtp.ehlo()
+        except SMTPHeloError:
+            await self.smtp.helo()
+
+    # Send one message, (re)opening the connection if it has been dropped or has reached its message limit.
+    # Returns the refused recipients, if only some of them were, as {address: SMTPResponse}.
+    async def send(self, msg, stats = None):
+        self.send_time = None
+        if self.is_connected() and self.sent_on_connection >= self.messages_per_connection:
+            await self.close()
+        if not self.is_connected():
+            await self.connect(stats)
+        self.sent_on_connection += 1
+        t = time.perf_counter()
+        try:
+            if isinstance(msg, EmailMessage):
+                refused, _ = await self.smtp.send_message(msg)
+                return refused
+            # Already serialized (see emailcontent.RawMessage), so send the bytes as-is
+            if (self.pipelining and self.smtp.supports_extension('pipelining')) or (self.chunking and self.smtp.supports_extension('chunking')):
+                return await self.transaction(msg)
+            refused, _ = await self.smtp.sendmail(msg.mail_from, msg.rcpt_to, msg.data)
+            return refused
+        finally:
+            self.send_time = time.perf_counter() - t
+
+    # One mail transaction, with PIPELINING and BDAT if enabled and offered. Raises the same exceptions as
+    # aiosmtplib's sendmail, with all the refused recipients in SMTPRecipientsRefused.
+    async def transaction(self, msg):
+        pipelining = self.pipelining and self.smtp.supports_extension('pipelining')
+        chunking = self.chunking and self.smtp.supports_extension('chunking')
+        data = msg.data
+        if not chunking:
+            data = PERIOD.sub(b'..', data) + b'.\r\n' # dot-stuffed, and terminated
+        mail = f'MAIL FROM:<{msg.mail_from}>'.encode()
+        rcpts = [f'RCPT TO:<{r}>'.encode() for r in msg.rcpt_to]
+        data_cmd = f'BDAT {len(data)} LAST'.encode() if chunking else b'DATA'
+        with ReplyReader(self.smtp.protocol) as conn:
+            data_reply = None
+            if pipelining:
+                # The whole envelope in one write, with the message too if chunking
+                await conn.write(b'\r\n'.join([mail] + rcpts + [data_cmd, data if chunking else b'']))
+                mail_reply = await conn.read_reply()
+                rcpt_replies = [await conn.read_reply() for _ in rcpts]
+                data_reply = await conn.read_reply()
+            else:
+                mail_reply = await conn.command(mail)
+                rcpt_replies = [await conn.command(r) for r in rcpts] if mail_reply.code == 250 else []
+                if any(r.code in (250, 251) for r in rcpt_replies):
+                    data_reply = await conn.command(data_cmd, data if chunking else None)
+            try:
+                refused = {r: reply for r, reply in zip(msg.rcpt_to, rcpt_replies) if reply.code not in (250, 251)}
+                if mail_reply.code != 250:
+                    raise SMTPSenderRefused(mail_reply.code, mail_reply.message, msg.mail_from)
+                if len(refused) == len(msg.rcpt_to):
+                    raise SMTPRecipientsRefused([SMTPRecipientRefused(reply.code, reply.message, r) for r, reply in refused.items()])
+                if not chunking:
+                    if data_reply.code != 354:
+                        raise SMTPDataError(data_reply.code, data_reply.message)
+                    await conn.write(data)
+                    data_reply = await conn.read_reply()
+                if data_reply.code != 250:
+                    raise SMTPDataError(data_reply.code, data_reply.message)
+                return refused
+            except (SMTPResponseException, SMTPRecipientsRefused):
+                if data_reply and data_reply.code == 354:
+                    # DATA accepted with no valid recipients (RFC 2920 3.1), so send an empty message to end it
+                    await conn.write(b'.\r\n')
+                    await conn.read_reply()
+                await conn.reset()
+                raise
+
+    async def close(self):
+        self.release()
+        if self.smtp is None:
+            return
+        try:
+            if self.smtp.is_connected:
+                await self.smtp.quit()
+        except (SMTPException, OSError):
+            pass
+        finally:
+            # Should be closed as we asked to QUIT, but if it's not, then close now
+            if self.smtp.is_connected:
+                self.smtp.close()
+            self.smtp = None
+
+
+PERIOD = re.compile(rb'(?m)^\.')
+
+
+# -----------------------------------------------------------------------------
+# Reads replies straight from the connection, so that commands can be pipelined. aiosmtplib expects one reply per
+# command, and drops any that arrive before it asks, so its protocol is swapped out for this one during a transaction.
+# -----------------------------------------------------------------------------
+class ReplyReader(asyncio.Protocol):
+    def __init__(self, protocol, timeout = 60):
+        self.protocol = protocol # aiosmtplib's, put back afterwards
+        self.transport = protocol.transport
+        self.timeout = timeout
+        self.buf = bytearray()
+        self.waiter = None
+        self.lost = None
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def __enter__(self):
+        if self.transport is None:
+            raise SMTPServerDisconnected('Connection lost')
+        self.transport.set_protocol(self)
+        return self
+
+    def __exit__(self, *exc):
+        if self.lost is None:
+            self.transport.set_protocol(self.protocol)
+
+    def data_received(self, data):
+        self.buf += data
+        self.wake()
+
+    def connection_lost(self, exc):
+        self.lost = SMTPServerDisconnected('Connection lost')
+        self.protocol.connection_lost(exc) # so the SMTP object knows it is disconnected
+        self.writable.set()
+        self.wake()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def wake(self):
+        if self.waiter and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def write(self, data):
+        if self.lost:
+            raise self.lost
+        self.transport.write(data)
+        await self.writable.wait()
+
+    # Send a command (and for BDAT, the data after it), and read its reply
+    async def command(self, cmd, data = None):
+        await self.write(cmd + b'\r\n')
+        if data is not None:
+            await self.write(data)
+        return await self.read_reply()
+
+    # Abandon the transaction after an error, ignoring any further problems
+    async def reset(self):
+        try:
+            await self.command(b'RSET')
+        except SMTPException:
+            pass
+
+    # Return the next reply, waiting for it if need be
+    async def read_reply(self):
+        while True:
+            reply = self.parse()
+            if reply:
+                return reply
+            if self.lost:
+                raise self.lost
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await asyncio.wait_for(self.waiter, self.timeout)
+            except asyncio.TimeoutError:
+                raise SMTPReadTimeoutError('Timed out waiting for server response') from None
+
+    # A complete (possibly multi-line) reply from the buffer, or None
+    def parse(self):
+        lines = []
+        offset = 0
+        while True:
+            i = self.buf.find(b'\n', offset)
+            if i == -1:
+                return None
+            line = bytes(self.buf[offset:i + 1])
+            offset = i + 1
+            lines.append(line[4:].strip(b' \t\r\n').decode('utf-8', 'surrogateescape'))
+            if line[3:4] != b'-':
+                del self.buf[:offset]
+                try:
+                    return SMTPResponse(int(line[:3]), '\n'.join(lines))
+                except ValueError:
+                    raise SMTPResponseException(-1, f'Malformed SMTP response line: {line!r}') from None
+
+
+# Exponential backoff from 0.5s, capped, with jitter so that connections don't all retry at once.
+# The jitter has its own generator, so retries don't disturb a seeded message stream.
+_jitter = random.Random()
+
+def backoff(n, max_backoff):
+    return min(max_backoff, 0.5 * 2 ** (n - 1)) * _jitter.uniform(0.5, 1.0)
+
+
+# Whether a failure might clear by trying again: a 4xx reply, or no connection or a dropped one. A 5xx reply or a
+# missing extension would be the same next time.
+def transient(e):
+    if isinstance(e, SMTPResponseException):
+        return 400 <= e.code < 500
+    return isinstance(e, OSError) # including aiosmtplib's disconnects and timeouts
+
+
+def record_phase(stats, phase, t):
+    now = time.perf_counter()
+    if stats:
+        stats.metrics.observe('smtp_traffic_gen_connection_phase_seconds', now - t, phase=phase)
+    return now
+
+
+# -----------------------------------------------------------------------------
+# Pacing: evenly spaced send deadlines at a global rate, shared by all connections
+# -----------------------------------------------------------------------------
+class RateLimiter:
+    def __init__(self, rate = 0.0):
+        self.interval = 1 / rate if rate > 0 else 0.0 # 0 = as fast as possible
+        self.next_t = None
+
+    # Wait for the next send slot, returning how late (in seconds) we are against it
+    async def wait(self):
+        if self.interval == 0:
+            return 0.0
+        now = time.perf_counter()
+        if self.next_t is None:
+            self.next_t = now
+        t = self.next_t
+        self.next_t += self.interval # reserve this slot, so concurrent callers get later ones
+        if t > now:
+            await asyncio.sleep(t - now)
+        return max(0.0, time.perf_counter() - t)
+
+
+# Pacing to a schedule: each send waits for the next of the given arrival times, in seconds from start (a time.time()
+# value). Sends are open-loop, so running behind doesn't delay later arrivals - it shows up as lag.
+class ScheduleLimiter:
+    def __init__(self, offsets, start = None):
+        if start is None:
+            start = time.time()
+        base = time.perf_counter() + start - time.time()
+        self.deadlines = iter([base + t for t in offsets])
+
+    async def wait(self):
+        t = next(self.deadlines, None)
+        if t is None:
+            return 0.0 # more messages than arrivals; send as fast as possible
+        now = time.perf_counter()
+        if t > now:
+            await asyncio.sleep(t - now)
+        return max(0.0, time.perf_counter() - t)
+
+
+# -----------------------------------------------------------------------------
+# Results of a send, which can be merged together
+# -----------------------------------------------------------------------------
+class SendStats:
+    def __init__(self):
+        self.attempted = 0
+        self.delivered = 0
+        self.failed = 0 # SMTP error reply to the message, permanent or still temporary after retries
+        self.lost = 0 # no reply: the connection failed, every time the message was tried
+        self.retries = 0
+        self.codes = {} # final reply code -> count
+        self.targets = {} # target name -> [delivered, failed, lost]
+        self.recipients = 0
+        self.refused = 0 # recipients refused individually, at RCPT TO
+        self.refused_codes = {} # reply code -> count
+        self.latency = array('d') # per-message send time, seconds
+        self.lag = array('d') # per-message lateness against the pacing schedule, seconds
+        self.generate_time = 0.0
+        self.backoff_time = 0.0 # waiting before retrying or reconnecting, summed over connections
+        self.elapsed = 0.0
+        self.first_connect = None # time.perf_counter() when the first connection was made
+        self.tls_full = array('d') # handshake times, seconds
+        self.tls_resumed = array('d')
+        self.metrics = Metrics()
+
+    # result is 'delivered', 'failed' or 'lost'; code is the SMTP reply code, or None if there wasn't one.
+    # latency is the time taken by the message's last attempt, or None if that never got as far as sending.
+    def record(self, result, code, latency, lag, target = None):
+        self.attempted += 1
+        counts = self.targets.setdefault(target or 'none', [0, 0, 0])
+        if result == 'delivered':
+            self.delivered += 1
+            counts[0] += 1
+        elif result == 'failed':
+            self.failed += 1
+            counts[1] += 1
+        else:
+            self.lost += 1
+            counts[2] += 1
+        code = str(code) if code else 'none'
+        self.codes[code] = self.codes.get(code, 0) + 1
+        self.lag.append(lag)
+        m = self.metrics
+        m.inc('smtp_traffic_gen_messages_attempted_total')
+        m.inc('smtp_traffic_gen_messages_total', result=result, code=code, target=target or 'none')
+        m.observe('smtp_traffic_gen_pacing_lag_seconds', lag)
+        if latency is not None:
+            self.latency.append(latency)
+            m.observe('smtp_traffic_gen_send_seconds', latency)
+            m.inc('smtp_traffic_gen_sending_seconds_total', latency)
+
+    # Recipients of a message that was accepted or refused at RCPT TO, with those refused as {address: SMTPResponse}
+    def record_recipients(self, n, refused):
+        self.recipients += n
+        self.refused += len(refused)
+        for reply in refused.values():
+            code = str(reply.code)
+            self.refused_codes[code] = self.refused_codes.get(code, 0) + 1
+            self.metrics.inc('smtp_traffic_gen_recipients_total', result='refused', code=code)
+        if n > len(refused):
+            self.metrics.inc('smtp_traffic_gen_recipients_total', n - len(refused), result='accepted', code='250')
+
+    # A message being tried again, after a temporary failure with this code (None if the connection failed)
+    def record_retry(self, code):
+        self.retries += 1
+        self.metrics.inc('smtp_traffic_gen_retries_total', code=str(code) if code else 'none')
+
+    # A TLS handshake, full or resuming an earlier session
+    def record_tls(self, seconds, resumed):
+        (self.tls_resumed if resumed else self.tls_full).append(seconds)
+        self.metrics.inc('smtp_traffic_gen_tls_handshakes_total', resumed=str(resumed).lower())
+        self.metrics.observe('smtp_traffic_gen_tls_handshake_seconds', seconds, resumed=str(resumed).lower())
+
+    def record_backoff(self, seconds):
+        self.backoff_time += seconds
+        self.metrics.inc('smtp_traffic_gen_backoff_seconds_total', seconds)
+
+    def record_generate(self, seconds):
+        self.generate_time += seconds
+        self.metrics.inc('smtp_traffic_gen_generate_seconds_total', seconds)
+
+    def merge(self, other):
+        self.attempted += other.attempted
+        self.delivered += other.delivered
+        self.failed += other.failed
+        self.lost += other.lost
+        self.retries += other.retries
+        for target, counts in other.targets.items():
+            self.targets[target] = [a + b for a, b in zip(self.targets.get(target, [0, 0, 0]), counts)]
+        for code, n in other.codes.items():
+            self.codes[code] = self.codes.get(code, 0) + n
+        self.recipients += other.recipients
+        self.refused += other.refused
+        for code, n in other.refused_codes.items():
+            self.refused_codes[code] = self.refused_codes.get(code, 0) + n
+        self.latency.extend(other.latency)
+        self.lag.extend(other.lag)
+        self.generate_time += other.generate_time
+        self.backoff_time += other.backoff_time
+        self.tls_full.extend(other.tls_full)
+        self.tls_resumed.extend(other.tls_resumed)
+        self.elapsed = max(self.elapsed, other.elapsed)
+        if other.first_connect is not None:
+            self.first_connect = min(self.first_connect or other.first_connect, other.first_connect) # perf_counter is system-wide, so workers' can be compared
+        self.metrics.merge(other.metrics)
+
+    def rate(self):
+        return self.attempted / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self, target_rate = 0.0):
+        s = f'{self.attempted} attempted, {self.delivered} delivered, {self.failed} failed, {self.lost} lost in {self.elapsed:.1f}s ' \
+            f'({self.rate():.1f} msg/s), {self.retries} retries'
+        if self.codes:
+            s += '\nreply codes: ' + ', '.join(f'{code} x{n}' for code, n in sorted(self.codes.items()))
+        if len(self.targets) > 1:
+            for target, (delivered, failed, lost) in sorted(self.targets.items()):
+                rate = (delivered + failed + lost) / self.elapsed if self.elapsed > 0 else 0.0
+                s += f'\n  {target}: {delivered} delivered, {failed} failed, {lost} lost ({rate:.1f} msg/s)'
+        if self.refused or self.recipients > self.attempted:
+            s += f'\nrecipients: {self.recipients - self.refused} accepted, {self.refused} refused'
+            if self.refused_codes:
+                s += ' (' + ', '.join(f'{code} x{n}' for code, n in sorted(self.refused_codes.items())) + ')'
+        if self.codes:
+            s += f'\ntime generating {self.generate_time:.2f}s, sending {sum(self.latency):.2f}s, backing off {self.backoff_time:.2f}s (summed over connections)'
+        if self.latency:
+            s += f'\nsend latency: mean {statistics.fmean(self.latency) * 1000:.1f}ms, p95 {percentile(self.latency, 95) * 1000:.1f}ms, ' \
+                f'max {max(self.latency) * 1000:.1f}ms'
+        if self.tls_full or self.tls_resumed:
+            s += f'\nTLS handshakes: {len(self.tls_full)} full' + (f' (mean {statistics.fmean(self.tls_full) * 1000:.1f}ms)' if self.tls_full else '') + \
+                f', {len(self.tls_resumed)} resumed' + (f' (mean {statistics.fmean(self.tls_resumed) * 1000:.1f}ms)' if self.tls_resumed else '')
+        if target_rate > 0 and self.lag:
+            s += f'\npacing: target {target_rate:.1f} msg/s, achieved {self.rate():.1f} msg/s ({100 * self.rate() / target_rate:.1f}%), ' \
+                f'lag mean {statistics.fmean(self.lag) * 1000:.1f}ms, p95 {percentile(self.lag, 95) * 1000:.1f}ms, max {max(self.lag) * 1000:.1f}ms'
+        return s
+
+
+def percentile(values, p):
+    v = sorted(values)
+    return v[min(len(v) - 1, int(len(v) * p / 100))]
+
+
+# -----------------------------------------------------------------------------
+# async SMTP email sending: long-lived connection workers fed from a queue
+# -----------------------------------------------------------------------------
+async def send_worker(queue: asyncio.Queue, session: SMTPSession, limiter: RateLimiter, stats: SendStats, headers={}):
+    while True:
+        msg = await queue.get()
+        if msg is None:
+            break
+        for hdr, value in headers.items():
+            msg.add_header(hdr, value) # once, before any attempt, as retries send the same message
+        lag = await limiter.wait()
+        for attempt in range(session.retries + 1):
+            if attempt:
+                stats.record_retry(code)
+                if session.is_connected():
+                    delay = backoff(attempt, session.max_backoff) # otherwise the reconnect backs off
+                    stats.record_backoff(delay)
+                    await asyncio.sleep(delay)
+            result, code = await send_one(session, msg, stats)
+            if result != 'retry':
+                break
+        else:
+            result = 'failed' if code else 'lost'
+        # Each attempt is timed on its own, so the latency leaves out reconnecting and backing off
+        stats.record(result, code, session.send_time, lag, session.target_name)
+
+
+# Try sending a message once, returning (result, code). The result is 'retry' for temporary failures: a 4xx reply,
+# or no reply because the connection failed. The session carries on with the next message either way.
+async def send_one(session: SMTPSession, msg, stats: SendStats):
+    try:
+        refused = await session.send(msg, stats)
+        session.pool.succeeded(session.target)
+        report_refused(refused)
+        stats.record_recipients(1 if isinstance(msg, EmailMessage) else len(msg.rcpt_to), refused)
+        return 'delivered', 250
+    except SMTPRecipientsRefused as e:
+        code = e.recipients[0].code
+        if all(400 <= r.code < 500 for r in e.recipients):
+            return 'retry', code
+        refused = {r.recipient: SMTPResponse(r.code, r.message) for r in e.recipients}
+        report_refused(refused)
+        stats.record_recipients(len(refused), refused)
+        return 'failed', code
+    except SMTPResponseException as e:
+        # e.g. SMTPSenderRefused, SMTPDataError, or refused AUTH
+        eprint('{}: {}'.format(type(e), str(e)))
+        if e.code == 421:
+            if session.target:
+                session.pool.failed(session.target)
+            await session.close() # the server is closing the connection
+        return ('retry' if 400 <= e.code < 500 else 'failed'), e.code
+    except (SMTPException, OSError) as e:
+        eprint('{}: {}'.format(type(e), str(e)))
+        await session.close() # reconnect for the next try
+        # A missing extension, e.g. STARTTLS required but not offered, won't change by trying again
+        return ('retry' if transient(e) else 'failed'), None
+
+
+# Each refused recipient is reported individually
+def report_refused(refused):
+    for rcpt, reply in refused.items():
+        eprint(f'Recipient refused: {rcpt}: {reply.code} {reply.message}')
+
+
+# f = an iterator (such as a generator function) that will yield the messages to be sent.
+# Messages are shared out over the sessions as each becomes free, at an overall rate (messages/second) if given,
+# or at the times set by a ScheduleLimiter. The stats are recorded into stats if given, so they can be read while sending.
+async def send_queued(f: Iterator, sessions: list, rate = 0.0, headers={}, limiter = None, stats = None):
+    stats = stats or SendStats()
+    limiter = limiter or RateLimiter(rate)
+    queue = asyncio.Queue(maxsize=2 * len(sessions)) # keep generation just ahead of sending
+    start_time = time.perf_counter()
+    workers = [asyncio.create_task(send_worker(queue, s, limiter, stats, headers)) for s in sessions]
+    try:
+        f = iter(f)
+        while True:
+            t = time.perf_counter()
+            msg = next(f, None)
+            stats.record_generate(time.perf_counter() - t)
+            if msg is None:
+                break
+            await queue.put(msg)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for w in workers:
+            w.cancel()
+    stats.elapsed = time.perf_counter() - start_time
+    return stats
+
+
+# Send a batch over new connections, closing them afterwards, to the servers given as a list of Targets (or just host and port).
+# Other per-connection settings are passed onwards via kwargs.
+async def send_batch(f: Iterator, messages_per_connection = 100, max_connections = 20, rate = 0.0, headers={}, servers = None,
+        host = 'localhost', port = 25, arrivals = None, tls_resumption = True, **kwargs):
+    pool = TargetPool(servers or [Target(host, port)])
+    tls_context = ClientTLSContext(tls_resumption)
+    sessions = [SMTPSession(messages_per_connection=messages_per_connection, pool=pool, tls_context=tls_context, **kwargs)
+        for _ in range(pool.capacity(max_connections))]
+    try:
+        return await send_queued(f, sessions, rate, headers, ScheduleLimiter(arrivals) if arrivals is not None else None)
+    finally:
+        await asyncio.gather(*[s.close() for s in sessions])
+
+
+# Cancel the current task when sig is received. Repeats are ignored, so they don't interrupt closing down.
+def stop_on_signal(sig):
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    def stop():
+        loop.add_signal_handler(sig, lambda: None)
+        task.cancel()
+    loop.add_signal_handler(sig, stop)
+
+
+# -----------------------------------------------------------------------------
+# Daemon mode: one long-running loop, sending a batch at the start of each minute
+# -----------------------------------------------------------------------------
+# next_batch(t) returns (batch_size, iterator of messages, arrivals) for the minute that datetime t is in. arrivals is
+# None to spread the batch evenly over the duration, or each message's time in seconds from the start of the minute,
+# leaving out those already past at t.
+# Each minute's batch is finished before the next one starts, so runs never overlap. If a batch overruns,
+# the missed minute boundaries are skipped rather than sent late.
+# Running totals of the metrics are served on metrics_host:metrics_port, up to the moment, and/or written to metrics_file
+# after each minute.
+async def run_daemon(next_batch: Callable, host='localhost', port=25, username=None, password=None, headers={},
+        messages_per_connection = 100, max_connections = 20, duration = 0, label = '', metrics_port = None, metrics_file = None,
+        metrics_host = 'localhost', pipelining = False, chunking = False, retries = 2, max_backoff = 10.0, servers = None, tls = None, tls_resumption = True):
+    pool = TargetPool(servers or [Target(host, port)])
+    tls_context = ClientTLSContext(tls_resumption)
+    sessions = [SMTPSession(username=username, password=password, messages_per_connection=messages_per_connection, pipelining=pipelining,
+        chunking=chunking, retries=retries, max_backoff=max_backoff, pool=pool, tls=tls, tls_context=tls_context)
+        for _ in range(pool.capacity(max_connections))]
+    totals = Metrics()
+    current = None # this minute's stats, until they are added to the totals
+
+    def live_metrics():
+        m = Metrics()
+        m.merge(totals)
+        if current:
+            m.merge(current.metrics)
+        return m
+
+    server = await serve_metrics(live_metrics, metrics_port, metrics_host) if metrics_port else None
+    # Stop cleanly on SIGTERM (e.g. from systemd) as well as Ctrl-C
+    stop_on_signal(signal.SIGTERM)
+    try:
+        while True:
+            t1 = time.time()
+            batch_size, msgs, arrivals = next_batch(datetime.datetime.now())
+            if arrivals is None:
+                # Cadence over the requested duration, but don't run into the next minute
+                this_duration = min(duration, 60 - t1 % 60 - 1) if duration > 0 else 0
+                rate = batch_size / this_duration if this_duration > 0 else 0
+                limiter = None
+            else:
+                rate = batch_size / (60 - t1 % 60) # on average over the rest of the minute, for reporting
+                limiter = ScheduleLimiter(arrivals, t1 - t1 % 60)
+            current = SendStats()
+            stats = await send_queued(msgs, sessions, rate, headers, limiter, current)
+            totals.merge(stats.metrics)
+            current = None
+            if metrics_file:
+                totals.write_textfile(metrics_file)
+            t2 = time.time()
+            print(f"{label}{time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(t1))} {stats.summary(rate)}\n"
+                  f"{label}{sum(s.is_connected() for s in sessions)} connections open", flush=True)
+            missed = int(t2 // 60 - t1 // 60)
+            if missed > 1:
+                eprint(f'{label}Batch overran, skipping {missed - 1} minute(s)')
+            await asyncio.sleep(60 - time.time() % 60)
+    except asyncio.CancelledError:
+        print(f"{label}Stopping", flush=True)
+    finally:
+        if server:
+            server.close()
+        await asyncio.gather(*[s.close() for s in sessions])
+
+
+# -----------------------------------------------------------------------------
+# Stress mode: find the most messages/second the servers can sustain. Load is offered in steps, each at a set rate
+# over a set number of connections, and adjusted AIMD-style after each one: while the servers keep up, with latency
+# and temporary failures within limits, the rate goes up (doubling at first, then additively). When they degrade,
+# the rate and connections are cut back multiplicatively. Connections are added when the servers are healthy but
+# the load isn't getting through.
+# -----------------------------------------------------------------------------
+class AIMDController:
+    def __init__(self, rate = 10.0, connections = 1, max_connections = 20, increase = None, decrease = 0.5, max_latency = None,
+            latency_factor = 4.0, min_latency = 0.05, max_tempfail = 0.05, keep_up = 0.95):
+        self.rate = rate # to offer in the next step, messages/second
+        self.connections = connections # to use in the next step
+        self.max_connections = max_connections
+        self.increase = increase # additive, messages/second per step; None = 5% of the rate where it first backs off
+        self.decrease = decrease # multiplicative
+        self.max_latency = max_latency # p95 seconds; None = latency_factor x the lowest p95 seen, but at least min_latency
+        self.latency_factor = latency_factor
+        self.min_latency = min_latency
+        self.max_tempfail = max_tempfail # share of messages with a 4xx reply, or no reply
+        self.keep_up = keep_up # share of the offered rate that must be achieved
+        self.slow_start = True # doubling, until the first back-off
+        self.best_p95 = None
+        self.backoffs = 0
+        self.ceiling = None # the best healthy step so far
+        self.last_added = None # the step after which connections were added, to see if they helped
+
+    def latency_limit(self):
+        if self.max_latency:
+            return self.max_latency
+        return max(self.min_latency, self.latency_factor * self.best_p95) if self.best_p95 is not None else None
+
+    # Judge a step's result, and set the rate and connections for the next. Returns what was decided.
+    def update(self, step: dict):
+        limit = self.latency_limit()
+        if step['tempfail'] > self.max_tempfail or (limit is not None and step['p95'] > limit):
+            return self.back_off(step, 'degraded')
+        if step['achieved'] < self.keep_up * step['offered']:
+            # Connections are only added while they help; if the last ones didn't, the servers (or this client) are the limit
+            added = self.last_added and step['achieved'] <= self.last_added['achieved']
+            if self.connections >= self.max_connections or added:
+                self.last_added = None
+                return self.back_off(step, 'saturated')
+            self.connections = min(self.max_connections, self.connections * 2 if self.slow_start else self.connections + 1)
+            self.last_added = step
+            return 'more connections'
+        self.last_added = None
+        if self.best_p95 is None or step['p95'] < self.best_p95:
+            self.best_p95 = step['p95']
+        if self.ceiling is None or step['achieved'] > self.ceiling['achieved']:
+            self.ceiling = step
+        self.rate = self.rate * 2 if self.slow_start else self.rate + self.increase
+        return 'ok'
+
+    def back_off(self, step, why):
+        if self.slow_start:
+            self.slow_start = False
+            if self.increase is None:
+                self.increase = max(1.0, 0.05 * step['offered'])
+        self.backoffs += 1
+        self.rate = max(1.0, self.rate * self.decrease)
+        self.connections = max(1, math.ceil(self.connections * self.decrease))
+        return f'{why}, backing off'
+
+
+# Offer load in steps of step_time seconds, until the controller has backed off max_backoffs times (or max_steps have run).
+# messages(n) returns an iterator of n messages. Each 4xx reply is counted once, as a sign of overload, so messages are not retried.
+# Returns the controller, holding the best sustained step, and the list of steps.
+async def run_stress(messages: Callable, controller: AIMDController, step_time = 10.0, max_backoffs = 3, max_steps = 50,
+        host='localhost', port=25, username=None, password=None, headers={}, messages_per_connection = 100,
+        pipelining = False, chunking = False, max_backoff = 10.0, servers = None, tls = None, tls_resumption = True, **kwargs):
+    pool = TargetPool(servers or [Target(host, port)])
+    tls_context = ClientTLSContext(tls_resumption)
+    controller.max_connections = pool.capacity(controller.max_connections)
+    sessions = []
+    steps = []
+    stop_on_signal(signal.SIGTERM)
+    try:
+        while controller.backoffs < max_backoffs and len(steps) < max_steps:
+            c = min(controller.connections, controller.max_connections)
+            while len(sessions) < c:
+                sessions.append(SMTPSession(username=username, password=password, messages_per_connection=messages_per_connection,
+                    pipelining=pipelining, chunking=chunking, retries=0, max_backoff=max_backoff, pool=pool, tls=tls, tls_context=tls_context))
+            # Connections no longer needed are closed, so the servers see the lower concurrency
+            await asyncio.gather(*[s.close() for s in sessions[c:]])
+            rate = controller.rate
+            stats = await send_queued(messages(max(1, round(rate * step_time))), sessions[:c], rate, headers)
+            tempfail = sum(n for code, n in stats.codes.items() if code.startswith('4')) + stats.lost
+            step = {
+                'connections': c,
+                'offered': rate,
+                'achieved': stats.rate(),
+                'p50': percentile(stats.latency, 50) if stats.latency else 0.0,
+                'p95': percentile(stats.latency, 95) if stats.latency else 0.0,
+                'tempfail': tempfail / stats.attempted if stats.attempted else 0.0,
+            }
+            step['verdict'] = controller.update(step)
+            steps.append(step)
+            print(f'step {len(steps)}: {describe_step(step)}', flush=True)
+    except asyncio.CancelledError:
+        print('Stopping', flush=True)
+    finally:
+        await asyncio.gather(*[s.close() for s in sessions])
+    return controller, steps
+
+
+def describe_step(step):
+    return f"{step['connections']} connections, offered {step['offered']:.1f} msg/s, achieved {step['achieved']:.1f} msg/s, " \
+        f"latency p50 {step['p50'] * 1000:.1f}ms p95 {step['p95'] * 1000:.1f}ms, 4xx/lost {100 * step['tempfail']:.1f}% - {step['verdict']}"
+
+
+# The ceiling found, and the latency measured at each throughput, lowest first
+def stress_report(controller: AIMDController, steps: list):
+    if controller.ceiling is None:
+        s = 'No step was sustained: try a lower --stress-rate'
+    else:
+        c = controller.ceiling
+        s = f"Maximum sustainable rate: {c['achieved']:.1f} msg/s, over {c['connections']} connections, latency p95 {c['p95'] * 1000:.1f}ms"
+    s += '\nlatency vs throughput:\n     msg/s  connections   p50 ms   p95 ms  4xx/lost %  verdict'
+    for step in sorted(steps, key=lambda step: step['achieved']):
+        s += f"\n  {step['achieved']:8.1f}  {step['connections']:11d}  {step['p50'] * 1000:7.1f}  {step['p95'] * 1000:7.1f}  " \
+            f"{100 * step['tempfail']:10.1f}  {step['verdict']}"
+    return s
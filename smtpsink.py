@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+#
+# Local SMTP sink for offline load testing. Honours the X-Bounce-Me / X-Bounce-Percentage headers that the generator
+# writes, like the Halon sink (https://github.com/tuck1s/halon-sink), and counts what it receives.
+
+import time, asyncio, argparse, random, re, signal, ssl
+
+MAX_LINE = 4096 # longest command line accepted
+MAX_SIZE = 50 * 1024 * 1024 # advertised SIZE limit
+
+BOUNCE_ME = re.compile(rb'^X-Bounce-Me:[ \t]*(.*)$', re.IGNORECASE | re.MULTILINE)
+BOUNCE_PERCENTAGE = re.compile(rb'^X-Bounce-Percentage:[ \t]*([0-9.]+)', re.IGNORECASE | re.MULTILINE)
+X_JOB = re.compile(rb'^X-Job:[ \t]*(.*)$', re.IGNORECASE | re.MULTILINE)
+REPLY = re.compile(r'^([245][0-9][0-9])\s+(.*)$', re.DOTALL)
+
+
+# -----------------------------------------------------------------------------
+# What the sink has received
+# -----------------------------------------------------------------------------
+class SinkStats:
+    def __init__(self):
+        self.connections = 0
+        self.messages = 0
+        self.recipients = 0
+        self.bytes = 0
+        self.replies = {} # reply code -> count
+        self.jobs = {} # X-Job -> [received, bounced]
+        self.tls_full = 0 # handshakes
+        self.tls_resumed = 0
+        self.start_time = time.perf_counter()
+
+    def record(self, job, code, size, recipients = 1):
+        self.messages += 1
+        self.recipients += recipients
+        self.bytes += size
+        self.replies[code] = self.replies.get(code, 0) + 1
+        j = self.jobs.setdefault(job, [0, 0])
+        j[0] += 1
+        if code[0] != '2':
+            j[1] += 1
+
+    def record_tls(self, ssl_object):
+        if ssl_object.session_reused:
+            self.tls_resumed += 1
+        else:
+            self.tls_full += 1
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start_time
+        s = f'{self.connections} connections, {self.messages} messages to {self.recipients} recipients ({self.bytes / 1e6:.1f} MB) in {elapsed:.1f}s ' \
+            f'({self.messages / elapsed if elapsed > 0 else 0:.1f} msg/s)'
+        if self.replies:
+            s += '\nreply codes: ' + ', '.join(f'{code} x{n}' for code, n in sorted(self.replies.items()))
+        if self.tls_full or self.tls_resumed:
+            s += f'\nTLS handshakes: {self.tls_full} full, {self.tls_resumed} resumed'
+        for job, (received, bounced) in sorted(self.jobs.items()):
+            s += f'\n  {job}: {received} received, {bounced} bounced ({100 * bounced / received:.1f}%)'
+        return s
+
+
+# -----------------------------------------------------------------------------
+# Buffered reading of lines and message data from a stream. Anything read past the end of a command or message
+# stays in the buffer, so pipelined commands are not lost.
+# -----------------------------------------------------------------------------
+class LineReader:
+    def __init__(self, reader: asyncio.StreamReader):
+        self.reader = reader
+        self.buf = bytearray()
+
+    async def fill(self):
+        chunk = await self.reader.read(65536)
+        if not chunk:
+            raise ConnectionResetError('Connection closed by client')
+        self.buf += chunk
+
+    async def readline(self):
+        while True:
+            i = self.buf.find(b'\n')
+            if i >= 0:
+                line = bytes(self.buf[:i + 1])
+                del self.buf[:i + 1]
+                return line
+            if len(self.buf) > MAX_LINE:
+                raise ValueError('Line too long')
+            await self.fill()
+
+    async def read_exactly(self, n):
+        while len(self.buf) < n:
+            await self.fill()
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    # Message content after DATA, up to the terminating <CRLF>.<CRLF>, with dot-stuffing removed
+    async def read_data(self):
+        start = 0
+        while True:
+            if self.buf.startswith(b'.\r\n'):
+                i = -2 # empty message
+            else:
+                i = self.buf.find(b'\r\n.\r\n', start)
+            if i != -1:
+                data = bytes(self.buf[:i + 2])
+                del self.buf[:i + 5]
+                return data.replace(b'\r\n..', b'\r\n.')
+            start = max(0, len(self.buf) - 4)
+            await self.fill()
+
+
+# Upgrade a server-side stream to TLS. StreamWriter.start_tls does this from Python 3.11; before that, the handshake is
+# run over the existing transport, then the writer and the stream's protocol are pointed at the new one.
+async def start_tls(writer: asyncio.StreamWriter, context: ssl.SSLContext):
+    if hasattr(writer, 'start_tls'):
+        await writer.start_tls(context)
+        return
+    protocol = writer.transport.get_protocol()
+    transport = await asyncio.get_running_loop().start_tls(writer.transport, protocol, context, server_side=True)
+    writer._transport = transport
+    protocol._transport = transport
+    protocol._over_ssl = True
+
+
+# -----------------------------------------------------------------------------
+# The sink server
+# -----------------------------------------------------------------------------
+class SMTPSink:
+    def __init__(self, hostname = 'smtp-sink', latency = 0.0, latency_jitter = 0.0, seed = None, rcpt_reject_percentage = 0.0,
+            tls_context: ssl.SSLContext = None):
+        self.hostname = hostname
+        self.latency = latency # seconds added before the reply to each message
+        self.latency_jitter = latency_jitter # +/- random variation on latency
+        self.rcpt_reject_percentage = rcpt_reject_percentage # chance of refusing each recipient, to test partial failures
+        self.random = random.Random(seed)
+        self.tls_context = tls_context # to offer STARTTLS, and for implicit TLS
+        self.stats = SinkStats()
+
+    # With implicit_tls, connections start with a TLS handshake (as on port 465), rather than upgrading with STARTTLS
+    async def start(self, host = 'localhost', port = 2525, implicit_tls = False):
+        return await asyncio.start_server(self.handle, host, port, ssl=self.tls_context if implicit_tls else None)
+
+    def ehlo_lines(self, tls = False):
+        return ['PIPELINING', f'SIZE {MAX_SIZE}', '8BITMIME', 'CHUNKING', 'ENHANCEDSTATUSCODES'] + \
+            (['STARTTLS'] if self.tls_context and not tls else []) + ['AUTH PLAIN LOGIN']
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.stats.connections += 1
+        r = LineReader(reader)
+        mail_from, rcpt_to = None, []
+        chunks = [] # BDAT data so far
+        ssl_object = writer.get_extra_info('ssl_object')
+        if ssl_object:
+            self.stats.record_tls(ssl_object)
+
+        def reply(s):
+            writer.write(s.encode() + b'\r\n')
+
+        reply(f'220 {self.hostname} ESMTP')
+        try:
+            while True:
+                line = await r.readline()
+                cmd, _, arg = line.decode('utf-8', 'replace').strip().partition(' ')
+                cmd = cmd.upper()
+                if cmd == 'EHLO':
+                    mail_from, rcpt_to = None, []
+                    exts = self.ehlo_lines(ssl_object is not None)
+                    writer.write(''.join(f'250-{e}\r\n' for e in [self.hostname] + exts[:-1]).encode())
+                    reply(f'250 {exts[-1]}')
+                elif cmd == 'HELO':
+                    mail_from, rcpt_to = None, []
+                    reply(f'250 {self.hostname}')
+                elif cmd == 'STARTTLS':
+                    if ssl_object or not self.tls_context:
+                        reply('503 5.5.1 Error: TLS already active' if ssl_object else '502 5.5.2 Error: command not recognized')
+                        continue
+                    reply('220 2.0.0 Ready to start TLS')
+                    await writer.drain()
+                    r.buf.clear() # anything sent before the handshake is discarded (RFC 3207)
+                    await start_tls(writer, self.tls_context)
+                    ssl_object = writer.get_extra_info('ssl_object')
+                    self.stats.record_tls(ssl_object)
+                    mail_from, rcpt_to, chunks = None, [], [] # the client starts again with EHLO
+                elif cmd == 'AUTH':
+                    await self.auth(r, arg, reply, writer)
+                elif cmd == 'MAIL':
+                    mail_from, rcpt_to = arg, []
+                    reply('250 2.1.0 Ok')
+                elif cmd == 'RCPT':
+                    if mail_from is None:
+                        reply('503 5.5.1 Error: need MAIL command')
+                    elif self.rcpt_reject_percentage and self.random.random() * 100 < self.rcpt_reject_percentage:
+                        reply('550 5.1.1 Recipient address rejected: User unknown')
+                    else:
+                        rcpt_to.append(arg)
+                        reply('250 2.1.5 Ok')
+                elif cmd == 'DATA':
+                    if not rcpt_to:
+                        reply('503 5.5.1 Error: need RCPT command')
+                        continue
+                    reply('354 End data with <CR><LF>.<CR><LF>')
+                    await writer.drain()
+                    data = await r.read_data()
+                    reply(await self.message_reply(data, len(rcpt_to)))
+                    mail_from, rcpt_to = None, []
+                elif cmd == 'BDAT':
+                    # The data is always read, even if the transaction has failed (RFC 3030)
+                    size, _, last = arg.partition(' ')
+                    if not size.isdigit() or last.upper() not in ('', 'LAST'):
+                        reply('501 5.5.4 Syntax: BDAT <size> [LAST]')
+                        continue
+                    chunks.append(await r.read_exactly(int(size)))
+                    if not rcpt_to:
+                        chunks = []
+                        reply('554 5.5.1 Error: no valid recipients')
+                    elif last:
+                        reply(await self.message_reply(b''.join(chunks), len(rcpt_to)))
+                        mail_from, rcpt_to, chunks = None, [], []
+                    else:
+                        reply(f'250 2.0.0 {size} octets received')
+                elif cmd == 'RSET':
+                    mail_from, rcpt_to, chunks = None, [], []
+                    reply('250 2.0.0 Ok')
+                elif cmd == 'NOOP':
+                    reply('250 2.0.0 Ok')
+                elif cmd == 'QUIT':
+                    reply('221 2.0.0 Bye')
+                    break
+                else:
+                    reply('502 5.5.2 Error: command not recognized')
+                if not r.buf:
+                    await writer.drain() # only once any pipelined commands have been answered
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError, ssl.SSLError):
+            pass
+        finally:
+            writer.close()
+
+    # Any credentials are accepted
+    async def auth(self, r, arg, reply, writer):
+        mechanism, _, initial = arg.partition(' ')
+        mechanism = mechanism.upper()
+        if mechanism == 'PLAIN':
+            if not initial:
+                reply('334 ')
+                await writer.drain()
+                await r.readline()
+        elif mechanism == 'LOGIN':
+            for prompt in (['VXNlcm5hbWU6'] if not initial else []) + ['UGFzc3dvcmQ6']: # "Username:", "Password:"
+                reply(f'334 {prompt}')
+                await writer.drain()
+                await r.readline()
+        else:
+            reply('504 5.5.4 Unrecognized authentication type')
+            return
+        reply('235 2.7.0 Authentication successful')
+
+    # Reply to a received message, as asked by its X-Bounce-Me header (with X-Bounce-Percentage probability)
+    async def message_reply(self, data: bytes, recipients = 1):
+        if self.latency > 0 or self.latency_jitter > 0:
+            await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.latency_jitter, self.latency_jitter)))
+        headers = data.split(b'\r\n\r\n', 1)[0].replace(b'\r\n ', b' ').replace(b'\r\n\t', b' ') # unfolded
+        m = X_JOB.search(headers)
+        job = m.group(1).strip().decode('utf-8', 'replace') if m else ''
+        text = bounce_reply(headers, self.random)
+        if text is None:
+            text = '250 2.0.0 Ok: queued'
+        self.stats.record(job, text[:3], len(data), recipients)
+        return text
+
+
+# Return the reply line asked for by the X-Bounce-Me header, or None to accept the message
+def bounce_reply(headers: bytes, rng = random):
+    m = BOUNCE_ME.search(headers)
+    if not m:
+        return None
+    p = BOUNCE_PERCENTAGE.search(headers)
+    if p and rng.random() * 100 >= float(p.group(1)):
+        return None
+    r = REPLY.match(m.group(1).strip().decode('utf-8', 'replace'))
+    if not r or r.group(1)[0] == '2':
+        return None
+    # e.g. '421 4.7.0 text', or with no enhanced code just '421 text'. Replies are one line, of limited length.
+    return f'{r.group(1)} {" ".join(r.group(2).split())}'[:510]
+
+
+# -----------------------------------------------------------------------------
+# Main code
+# -----------------------------------------------------------------------------
+# Server-side TLS from a certificate and key, e.g. self-signed for testing
+def server_tls_context(cert, key = None):
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+async def main(args):
+    tls_context = server_tls_context(args.tls_cert, args.tls_key) if args.tls_cert else None
+    sink = SMTPSink(latency=args.latency, latency_jitter=args.latency_jitter, seed=args.seed, rcpt_reject_percentage=args.rcpt_reject_percentage,
+        tls_context=tls_context)
+    servers = [await sink.start(args.host, args.port)]
+    print(f'Listening on {args.host}:{args.port}' + (', offering STARTTLS' if tls_context else ''), flush=True)
+    if args.tls_port:
+        servers.append(await sink.start(args.host, args.tls_port, implicit_tls=True))
+        print(f'Listening with implicit TLS on {args.host}:{args.tls_port}', flush=True)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        while True:
+            await asyncio.sleep(args.report_interval)
+            print(sink.stats.summary(), flush=True)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        for server in servers:
+            server.close()
+        print(sink.stats.summary(), flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Local SMTP sink, replying to each message as asked by its X-Bounce-Me and X-Bounce-Percentage headers')
+    parser.add_argument('--host', type=str, default='localhost', help='address to listen on')
+    parser.add_argument('--port', type=int, default=2525, help='port to listen on')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before replying to each message')
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help='random +/- variation on the latency, in seconds')
+    parser.add_argument('--rcpt-reject-percentage', type=float, default=0.0, help='refuse this percentage of recipients at RCPT TO, at random')
+    parser.add_argument('--report-interval', type=float, default=10, help='seconds between printing what has been received')
+    parser.add_argument('--seed', type=str, help='random seed, for repeatable bounce decisions')
+    parser.add_argument('--tls-cert', type=str, help='certificate file (PEM), to offer STARTTLS')
+    parser.add_argument('--tls-key', type=str, help='private key file (PEM), if not in the certificate file')
+    parser.add_argument('--tls-port', type=int, help='also listen on this port with implicit TLS, like port 465 (needs --tls-cert)')
+    args = parser.parse_args()
+    if args.tls_port and not args.tls_cert:
+        parser.error('--tls-port needs --tls-cert')
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+#
+# Spool of pre-generated messages: raw RFC 5322 bytes plus envelope, so a corpus can be generated once and replayed
+# many times without any MIME work at send time.
+#
+# File layout: MAGIC, then one record per message, each a header of three little-endian uint32 lengths
+# (mail_from, rcpt_to, data) followed by those fields. rcpt_to is the recipient addresses joined by newlines.
+
+import mmap, struct
+from array import array
+from emailcontent import RawMessage
+
+MAGIC = b'SMTPSPOOL1\n'
+RECORD = struct.Struct('<III')
+
+
+# Write messages (RawMessage objects) to a spool file, returning how many were written
+def write_spool(path, messages):
+    n = 0
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        for msg in messages:
+            mail_from = msg.mail_from.encode('utf-8')
+            rcpt_to = '\n'.join(msg.rcpt_to).encode('utf-8')
+            f.write(RECORD.pack(len(mail_from), len(rcpt_to), len(msg.data)))
+            f.write(mail_from)
+            f.write(rcpt_to)
+            f.write(msg.data)
+            n += 1
+    return n
+
+
+# -----------------------------------------------------------------------------
+# A spool file, memory-mapped. Message data is returned as a view into the mapping, so is not copied.
+# -----------------------------------------------------------------------------
+class Spool:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a spool file')
+        self.view = memoryview(self.mm)
+        # Index of record offsets, so messages can be read in any order, or shared between workers
+        self.offsets = array('Q')
+        pos, end = len(MAGIC), len(self.mm)
+        while pos < end:
+            self.offsets.append(pos)
+            a, b, c = RECORD.unpack_from(self.mm, pos)
+            pos += RECORD.size + a + b + c
+        if pos != end:
+            raise ValueError(f'{path} is truncated')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        pos = self.offsets[i]
+        a, b, c = RECORD.unpack_from(self.mm, pos)
+        pos += RECORD.size
+        mail_from = str(self.mm[pos:pos + a], 'utf-8')
+        rcpt_to = str(self.mm[pos + a:pos + a + b], 'utf-8').split('\n')
+        pos += a + b
+        return RawMessage(mail_from, rcpt_to, self.view[pos:pos + c])
+
+    # Yield n messages from this share of the spool (messages start, start + step, ...), beginning offset messages
+    # into the share and going round again if needed. By default, all of the spool once.
+    def messages(self, n = None, start = 0, step = 1, offset = 0):
+        share = range(start, len(self), step)
+        if n is None:
+            n = len(share)
+        if n > 0 and not share:
+            raise ValueError('spool has too few messages')
+        for j in range(offset, offset + n):
+            yield self[share[j % len(share)]]
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+#
+# Text with {{placeholder}}s, parsed once into literal parts and placeholder slots, so filling it in is one join,
+# however many placeholders there are and however long the text is. Works on str or bytes.
+
+import re
+
+PLACEHOLDER = re.compile(r'\{\{(\w+)\}\}')
+PLACEHOLDER_BYTES = re.compile(rb'\{\{(\w+)\}\}')
+
+
+class Template:
+    # Only the placeholders in names (if given) are recognised; any others are left as they are
+    def __init__(self, text, names = None):
+        self.empty = text[:0]
+        pattern = PLACEHOLDER_BYTES if isinstance(text, bytes) else PLACEHOLDER
+        self.parts = [] # literal text, with None where each placeholder goes
+        self.slots = [] # (index in parts, placeholder name)
+        pos = 0
+        for m in pattern.finditer(text):
+            name = m.group(1).decode('ascii') if isinstance(text, bytes) else m.group(1)
+            if names is None or name in names:
+                self.parts += [text[pos:m.start()], None]
+                self.slots.append((len(self.parts) - 1, name))
+                pos = m.end()
+        self.parts.append(text[pos:])
+        self.names = tuple(dict.fromkeys(name for _, name in self.slots)) # each placeholder used, once, in order
+
+    # values maps each placeholder name to its text
+    def render(self, values: dict):
+        if not self.slots:
+            return self.parts[0]
+        parts = self.parts.copy()
+        for i, name in self.slots:
+            parts[i] = values[name]
+        return self.empty.join(parts)
+
+    # A new template with the given placeholders filled in, and the others left to do
+    def fill(self, values: dict):
+        rest = [name for name in self.names if name not in values]
+        return Template(self.render(dict({name: self.placeholder(name) for name in rest}, **values)), rest)
+
+    # The literal parts either side of each placeholder (one more than there are placeholders), and the placeholder names
+    def literals(self):
+        return self.parts[::2], [name for _, name in self.slots]
+
+    def placeholder(self, name):
+        return '{{' + name + '}}' if isinstance(self.empty, str) else b'{{' + name.encode('ascii') + b'}}'
+
+
+# -----------------------------------------------------------------------------
+# Main code - for testing
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    import time
+    t = Template('Hello {{name}}, from {{sender}}. {{unknown}} Bye {{name}}!', names=('name', 'sender'))
+    print(t.names, t.render({'name': 'Alice', 'sender': 'Bob'}))
+    print(t.fill({'sender': 'Bob'}).render({'name': 'Carol'}))
+    body = open('emailcontent.html').read()
+    t = Template(body)
+    n = 10000
+    start = time.perf_counter()
+    for i in range(n):
+        t.render({'top': 'Acme', 'name': 'Acme Adventures', 'recipient': 'alice@example.com', 'recipient_name': 'Alice',
+            'unsubscribe_url': 'https://example.com/u/1', 'tracking_url': 'https://example.com/o/1'})
+    t_template = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(n):
+        body.replace('{{top}}', 'Acme').replace('{{name}}', 'Acme Adventures')
+    t_replace = time.perf_counter() - start
+    print(f'{len(body)} byte body: compiled template {t_template / n * 1e6:.2f}us, two replace passes {t_replace / n * 1e6:.2f}us')
@@ -1,56 +1,183 @@
 #!/usr/bin/env python3
 
-import random, datetime, zoneinfo, math
+import random, datetime, zoneinfo, math, csv, os, io
+from array import array
+
+DEFAULT_PROFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'traffic_profile.csv')
 
 # -----------------------------------------------------------------------------
 # Traffic model
 # -----------------------------------------------------------------------------
 class Traffic:
-    def __init__(self):
-        # typical triggered email busy hour curve (from 00:00 to 23:00 each day) - slightly more morning traffic for European timezones
-        triggered_volume_per_hour = [2, 1, 1, 2, 5, 12, 14, 6, 8, 10, 19, 27, 29, 28, 28, 26, 25, 24, 22, 19, 16, 14, 11, 8]
-        # normalise, so that the sum of all the hourly volume would be ~ 1.0
-        total = sum(triggered_volume_per_hour)
-        self.normalised_triggered_volume_per_hour = [v / total for v in triggered_volume_per_hour]
-        # set a window for random variability
+    def __init__(self, profile_file: io.TextIOBase = None, seed = None):
+        # Busy hour curves (from 00:00 to 23:00 each day), each in its own time zone and with its share of the volume.
+        # The default is a typical triggered email curve for US East-Coast senders - slightly more morning traffic for European timezones
+        if profile_file is None:
+            with open(DEFAULT_PROFILE, 'r') as f:
+                self.profiles = load_profiles(f)
+        else:
+            self.profiles = load_profiles(profile_file)
+        self.rng = random.Random(seed) # our own, so the model doesn't disturb other random streams
+        self.schedule = None # the current day's Schedule, once made
+
+    def seed(self, seed = None):
+        self.rng.seed(seed)
+        self.schedule = None
 
+    # Mean volume for the minute starting at t, including the random variability
+    def expected_volume_this_minute(self, t: datetime.datetime, daily_vol: float):
+        v = 0.0
+        for zone, curve in self.profiles:
+            c = t.astimezone(zone)
+            # interpolate the volume between the value for this hour and the next hour (wrapping around)
+            next_hour_fraction = c.minute / 60
+            v += curve[c.hour] * (1 - next_hour_fraction) + curve[(c.hour + 1) % 24] * next_hour_fraction
+        c = t.astimezone(self.profiles[0][0])
+        return daily_vol * v / 60 * self.pseudorandom(c.day, c.hour, c.minute)
 
     def volume_this_minute(self, t: datetime.datetime, daily_vol: float):
-        c = t.astimezone(zoneinfo.ZoneInfo('America/New_York'))
-        # interpolate the volume between the value for this hour and the next hour (wrapping around)
-        this_hour_vol = self.normalised_triggered_volume_per_hour[c.hour]
-        next_hour_vol = self.normalised_triggered_volume_per_hour[(c.hour + 1) % 24]
-        assert (c.minute >= 0) and (c.minute <=59)
-        next_hour_fraction = c.minute / 60
-        this_hour_fraction = 1 - next_hour_fraction
-        this_minute_vol = daily_vol * (this_hour_vol * this_hour_fraction + next_hour_vol * next_hour_fraction) / 60
         # Add random 'dither' to ensure we sometimes send something, even on low daily volume targets
-        vary = self.pseudorandom(c.day, c.hour, c.minute)
-        this = int(math.floor(this_minute_vol * vary) + random.random())
-        return this
-    
+        return int(math.floor(self.expected_volume_this_minute(t, daily_vol)) + self.rng.random())
+
     # Choose a pseudo-random value between low_v and high_v that's fairly consistent over an M minute interval
     def pseudorandom(self, day, hour, minute):
         coarse_variability = 0.3
         fine_variability = 0.05
         M = 7
         seed = minute//M + hour + day
-        random.seed(seed)
-        vary = random.uniform(1-coarse_variability, 1+coarse_variability)
-        random.seed()
-        vary += random.uniform(-fine_variability, fine_variability)
+        vary = random.Random(seed).uniform(1-coarse_variability, 1+coarse_variability)
+        vary += self.rng.uniform(-fine_variability, fine_variability)
         return vary
 
+    # Arrival times for the minute starting at t, in seconds from t, from a schedule made for the whole day
+    def arrivals_this_minute(self, t: datetime.datetime, daily_vol: float, arrivals = 'poisson', resolution = 1.0, burst_size = 10):
+        t = t.astimezone()
+        s = self.schedule
+        if not (s and s.daily_vol == daily_vol and s.arrivals == arrivals and s.resolution == resolution and s.burst_size == burst_size
+                and s.start <= t < s.end):
+            midnight = t.replace(hour=0, minute=0, second=0, microsecond=0)
+            s = self.schedule = Schedule(self, midnight, daily_vol, arrivals, resolution, burst_size)
+        return s.arrivals_this_minute(t, self.rng)
+
+    # Arrival times for exactly n messages in one minute, in seconds from its start, from start seconds onwards
+    def arrivals(self, n, arrivals = 'poisson', burst_size = 10, start = 0.0):
+        if arrivals == 'even':
+            return [start + i * (60 - start) / n for i in range(n)]
+        if arrivals == 'poisson':
+            # a Poisson process, given how many arrive in the interval, places them uniformly at random
+            return sorted(self.rng.uniform(start, 60) for _ in range(n))
+        # bursty: clusters of messages, each arriving all at once
+        offsets = []
+        while len(offsets) < n:
+            t = self.rng.uniform(start, 60)
+            offsets += [t] * min(n - len(offsets), geometric(self.rng, burst_size))
+        return sorted(offsets)
+
+
+# -----------------------------------------------------------------------------
+# A day's message arrivals, as the number arriving in each interval of `resolution` seconds. The rate follows the
+# traffic model's curve; arrivals are 'even' (spread to match the rate), 'poisson', or 'bursty' (Poisson arrivals
+# of clusters, averaging burst_size messages).
+# -----------------------------------------------------------------------------
+class Schedule:
+    def __init__(self, traffic: Traffic, start: datetime.datetime, daily_vol, arrivals = 'poisson', resolution = 1.0, burst_size = 10,
+            hours = 25): # a day can be 25 hours long, when the clocks go back
+        self.start = start
+        self.end = start + datetime.timedelta(hours=hours)
+        self.daily_vol = daily_vol
+        self.arrivals = arrivals
+        self.resolution = resolution
+        self.burst_size = burst_size
+        self.per_minute = round(60 / resolution) # intervals
+        self.counts = array('I')
+        rng = traffic.rng
+        carry = 0.0
+        for m in range(hours * 60):
+            lam = traffic.expected_volume_this_minute(start + datetime.timedelta(minutes=m), daily_vol) / self.per_minute
+            for _ in range(self.per_minute):
+                if arrivals == 'even':
+                    carry += lam
+                    n = int(carry)
+                    carry -= n
+                elif arrivals == 'poisson':
+                    n = poisson(rng, lam)
+                else:
+                    n = sum(geometric(rng, burst_size) for _ in range(poisson(rng, lam / burst_size)))
+                self.counts.append(n)
+
+    # Arrival times in the minute starting at t, in seconds from t
+    def arrivals_this_minute(self, t: datetime.datetime, rng: random.Random):
+        i = int((t - self.start).total_seconds() / 60) * self.per_minute
+        offsets = []
+        for j in range(self.per_minute):
+            n = self.counts[i + j]
+            if n == 0:
+                continue
+            slot = j * self.resolution
+            if self.arrivals == 'even':
+                offsets += [slot + (k + 0.5) * self.resolution / n for k in range(n)]
+            elif self.arrivals == 'poisson':
+                offsets += sorted(slot + rng.random() * self.resolution for _ in range(n))
+            else:
+                offsets += [slot + rng.random() * self.resolution] * n # all together
+        return offsets
+
+
+# Each profile is (time zone, curve), where the curve is the share of the whole day's volume in each hour.
+# File rows are: timezone, share, then 24 hourly values, of any scale.
+def load_profiles(f: io.TextIOBase):
+    rows = [row for row in csv.reader(f) if row and row[0] != 'timezone' and not row[0].startswith('#')] # skip the header row
+    total_share = sum(float(row[1]) for row in rows)
+    profiles = []
+    for row in rows:
+        hourly = [float(v) for v in row[2:26]]
+        if len(hourly) != 24:
+            raise ValueError(f'traffic profile for {row[0]} needs 24 hourly values')
+        # normalise, so that the sum of all the hourly volume would be ~ the profile's share
+        scale = float(row[1]) / total_share / sum(hourly)
+        profiles.append((zoneinfo.ZoneInfo(row[0]), [v * scale for v in hourly]))
+    return profiles
+
+
+# Random Poisson-distributed count with mean lam
+def poisson(rng: random.Random, lam):
+    if lam < 30:
+        # Knuth's method
+        L = math.exp(-lam)
+        k = 0
+        p = rng.random()
+        while p > L:
+            k += 1
+            p *= rng.random()
+        return k
+    return max(0, round(rng.gauss(lam, math.sqrt(lam)))) # normal approximation
+
+
+# Random geometric-distributed count (1, 2, ...) with the given mean
+def geometric(rng: random.Random, mean):
+    if mean <= 1:
+        return 1
+    return 1 + int(math.log(1.0 - rng.random()) / math.log(1 - 1 / mean))
+
+
 # -----------------------------------------------------------------------------
 # Main code - for testing
 # -----------------------------------------------------------------------------
 if __name__ == "__main__":
-    traffic_model = Traffic()
+    import statistics, time
+    traffic_model = Traffic(seed=1)
     t = datetime.datetime(2023, 7, 18, 0, 0, 0, 0, zoneinfo.ZoneInfo('America/New_York'))
     actuals = []
     for i in range(0, 60*24):
         vol = traffic_model.volume_this_minute(t, 100000)
         t += datetime.timedelta(minutes=1)
         actuals.append(vol)
-    import statistics
-    print(f'Sum = {sum(actuals)}, mean = {statistics.mean(actuals):.3f}, std dev = {statistics.stdev(actuals):.3f}')
\ No newline at end of file
+    print(f'Sum = {sum(actuals)}, mean = {statistics.mean(actuals):.3f}, std dev = {statistics.stdev(actuals):.3f}')
+
+    # Per-second schedules for the same day. Bursty arrivals have the same mean, but much more variation.
+    t = datetime.datetime(2023, 7, 18, 0, 0, 0, 0, zoneinfo.ZoneInfo('America/New_York'))
+    for arrivals in ('even', 'poisson', 'bursty'):
+        t1 = time.perf_counter()
+        s = Schedule(traffic_model, t, 100000, arrivals, hours=24)
+        print(f'{arrivals}: sum = {sum(s.counts)}, max per second = {max(s.counts)}, '
+              f'std dev per second = {statistics.pstdev(s.counts):.3f}, made in {time.perf_counter() - t1:.2f}s')